@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from itertools import accumulate
+from pathlib import Path
+
+import httpx
+
+# Load test for the chat API. Drives /api/chat (or /api/chat/stream with --stream) either with a fixed number of
+# concurrent users (closed loop) or at a fixed request rate (open loop, --rate), and reports throughput, latency
+# percentiles, time to first token and errors as JSON.
+#
+# With --spawn it brings up its own stack first: the stand-in LLM and ES from bench_fakes.py plus the API pointed at
+# them. That takes the inference server and the cluster out of the picture, so what's left is the cost of our own
+# code, and a regression in RAGAgent or ESSearch shows up as a change in these numbers.
+#
+#   cd scripts && python bench_chat.py --spawn --stream --concurrency 16 --duration 30 --output bench.json
+
+ROOT = Path(__file__).resolve().parents[1]
+SCRIPTS = Path(__file__).resolve().parent
+
+QUESTIONS = [
+    "What is the Necronomicon?",
+    "Who is Cthulhu and where does he sleep?",
+    "Describe the town of Innsmouth.",
+    "What happened at the Miskatonic University expedition to Antarctica?",
+    "What are the Mi-Go?",
+    "Tell me about the colour out of space.",
+    "Who was Wilbur Whateley?",
+    "What is R'lyeh like?",
+    "What did Randolph Carter find in his dreams?",
+    "Why do the Deep Ones come to Innsmouth?",
+]
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)], 2)
+
+    return {
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "mean": round(statistics.mean(ordered), 2),
+        "max": round(ordered[-1], 2),
+    }
+
+
+async def chat_once(client: httpx.AsyncClient, question: str, args) -> dict:
+    payload = {
+        "messages": [{"role": "user", "content": question}],
+        "bypass_cache": args.bypass_cache,
+    }
+    start = time.perf_counter()
+    result = {"ok": False, "ttft_ms": None, "tokens": 0}
+    try:
+        if not args.stream:
+            res = await client.post("/api/chat", json=payload)
+            result["status"] = res.status_code
+            result["ok"] = res.status_code == 200
+            if not result["ok"]:
+                result["error"] = f"http_{res.status_code}"
+        else:
+            async with client.stream("POST", "/api/chat/stream", json=payload) as res:
+                result["status"] = res.status_code
+                if res.status_code != 200:
+                    result["error"] = f"http_{res.status_code}"
+                else:
+                    event = "message"
+                    async for line in res.aiter_lines():
+                        if line.startswith("event:"):
+                            event = line.split(":", 1)[1].strip()
+                        elif line.startswith("data:"):
+                            if event == "message":
+                                if result["ttft_ms"] is None:
+                                    result["ttft_ms"] = (
+                                        time.perf_counter() - start
+                                    ) * 1000
+                                result["tokens"] += 1
+                            elif event == "error":
+                                result["error"] = "stream_error"
+                            elif event == "done":
+                                result["ok"] = "error" not in result
+                            event = "message"
+                    if not result["ok"] and "error" not in result:
+                        result["error"] = "stream_incomplete"
+    except httpx.TimeoutException:
+        result["error"] = "timeout"
+    except httpx.HTTPError as e:
+        result["error"] = type(e).__name__
+    result["latency_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+async def closed_loop(client, questions, args) -> list[dict]:
+    # Every user sends its next question as soon as the previous answer is complete.
+    results = []
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    remaining = args.requests
+
+    async def user():
+        nonlocal remaining
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if deadline is None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            results.append(await chat_once(client, random.choice(questions), args))
+
+    await asyncio.gather(*(user() for _ in range(args.concurrency)))
+    return results
+
+
+async def open_loop(client, questions, args) -> list[dict]:
+    """
+    Start requests on a fixed schedule no matter how fast answers come back, which is how real traffic arrives.
+    Latency is measured from the scheduled start, so time spent waiting for a free slot (--concurrency caps the
+    requests in flight) counts against us instead of quietly lowering the load.
+    """
+    limit = asyncio.Semaphore(args.concurrency)
+    total = int(args.duration * args.rate) if args.duration else args.requests
+    if args.poisson:
+        # Exponential gaps between arrivals, i.e. a Poisson process with the given mean rate.
+        gaps = [random.expovariate(args.rate) for _ in range(total)]
+        offsets = list(accumulate(gaps[:-1], initial=0.0))
+    else:
+        offsets = [i / args.rate for i in range(total)]
+
+    async def scheduled(at: float):
+        async with limit:
+            queued_ms = (time.perf_counter() - at) * 1000
+            result = await chat_once(client, random.choice(questions), args)
+        result["latency_ms"] += queued_ms
+        if result["ttft_ms"] is not None:
+            result["ttft_ms"] += queued_ms
+        return result
+
+    start = time.perf_counter()
+    tasks = []
+    for offset in offsets:
+        at = start + offset
+        await asyncio.sleep(max(at - time.perf_counter(), 0))
+        tasks.append(asyncio.create_task(scheduled(at)))
+    return await asyncio.gather(*tasks)
+
+
+def summarize(results: list[dict], elapsed: float, args) -> dict:
+    ok = [r for r in results if r["ok"]]
+    errors = Counter(r.get("error", "unknown") for r in results if not r["ok"])
+    summary = {
+        "mode": "open" if args.rate else "closed",
+        "endpoint": "/api/chat/stream" if args.stream else "/api/chat",
+        "concurrency": args.concurrency,
+        "target_rate": args.rate or None,
+        "duration_s": round(elapsed, 2),
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": dict(errors),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0,
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0,
+        "latency_ms": percentiles([r["latency_ms"] for r in ok]),
+    }
+    if args.stream:
+        summary["ttft_ms"] = percentiles(
+            [r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]
+        )
+        summary["tokens_per_response"] = (
+            round(statistics.mean(r["tokens"] for r in ok), 1) if ok else 0
+        )
+    return summary
+
+
+def wait_for(url: str, timeout: float, proc: subprocess.Popen):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{' '.join(proc.args)} exited with {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} didn't come up within {timeout:.0f}s")
+
+
+def spawn_stack(args) -> list[subprocess.Popen]:
+    """
+    Start the stand-in LLM and ES and the API pointed at them. The API keeps the rest of its configuration (encoder,
+    caches, search mode) from the environment, so those are part of what's measured.
+    """
+    python = sys.executable
+    llm_port, es_port = args.port + 1, args.port + 2
+    fake = [python, str(SCRIPTS / "bench_fakes.py")]
+    procs = [
+        subprocess.Popen(
+            fake
+            + ["openai", "--port", str(llm_port), "--ttft-ms", str(args.llm_ttft_ms)]
+            + ["--tokens-per-second", str(args.llm_tokens_per_second)]
+            + [
+                "--tokens",
+                str(args.llm_tokens),
+                "--error-rate",
+                str(args.llm_error_rate),
+            ]
+        ),
+        subprocess.Popen(
+            fake
+            + ["es", "--port", str(es_port), "--latency-ms", str(args.es_latency_ms)]
+            + (
+                ["--corpus", os.environ["CORPUS_JSONL_FILE"]]
+                if os.getenv("CORPUS_JSONL_FILE")
+                else []
+            )
+        ),
+    ]
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT / "src"),
+        "INFERENCE_API_URL": f"http://127.0.0.1:{llm_port}",
+        "INFERENCE_API_KEY": "bench",
+        "INFERENCE_MODEL_NAME": "bench-model",
+        "ES_HOST": f"http://127.0.0.1:{es_port}",
+        "SEARCH_BACKEND": "elasticsearch",
+    }
+    procs.append(
+        subprocess.Popen(
+            [
+                python,
+                "-m",
+                "uvicorn",
+                "main:app",
+                "--port",
+                str(args.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=ROOT / "src",
+            env=env,
+        )
+    )
+    try:
+        wait_for(f"http://127.0.0.1:{llm_port}/v1/models", 30, procs[0])
+        wait_for(f"http://127.0.0.1:{es_port}/", 30, procs[1])
+        # The API answers straight away but loads the encoder and checks its backends in the background. Readiness
+        # stays 503 until that's done, so wait for it rather than letting the warm-up requests race it.
+        wait_for(f"http://127.0.0.1:{args.port}/health/ready", 300, procs[2])
+    except Exception:
+        stop_stack(procs)
+        raise
+    args.url = f"http://127.0.0.1:{args.port}"
+    return procs
+
+
+def stop_stack(procs: list[subprocess.Popen]):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def run(args) -> dict:
+    questions = QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, "r", encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+    limits = httpx.Limits(
+        max_connections=args.concurrency, max_keepalive_connections=args.concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=args.timeout, limits=limits
+    ) as client:
+        # A few untimed requests so model loading and connection setup don't end up in the percentiles.
+        await asyncio.gather(
+            *(chat_once(client, q, args) for q in questions[: args.warmup])
+        )
+        start = time.perf_counter()
+        if args.rate:
+            results = await open_loop(client, questions, args)
+        else:
+            results = await closed_loop(client, questions, args)
+        elapsed = time.perf_counter() - start
+    return summarize(results, elapsed, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat API.")
+    parser.add_argument(
+        "--url", default="http://localhost:8000", help="API to test, unless --spawn."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Users (closed loop) or max requests in flight.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Requests per second. Switches to an open loop.",
+    )
+    parser.add_argument(
+        "--poisson",
+        action="store_true",
+        help="Random (Poisson) arrivals at --rate instead of evenly spaced.",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=30,
+        help="Seconds to run. 0 to use --requests.",
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Use /api/chat/stream and measure time to first token.",
+    )
+    parser.add_argument(
+        "--bypass-cache", action="store_true", help="Skip the semantic answer cache."
+    )
+    parser.add_argument(
+        "--questions-file", help="One question per line. Defaults to a built in set."
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    stack = parser.add_argument_group("spawned stack")
+    stack.add_argument(
+        "--spawn",
+        action="store_true",
+        help="Start the API against stand-in LLM and ES servers.",
+    )
+    stack.add_argument(
+        "--port", type=int, default=8100, help="API port. The fakes take the next two."
+    )
+    stack.add_argument("--llm-ttft-ms", type=float, default=100)
+    stack.add_argument("--llm-tokens-per-second", type=float, default=50)
+    stack.add_argument("--llm-tokens", type=int, default=100)
+    stack.add_argument("--llm-error-rate", type=float, default=0)
+    stack.add_argument("--es-latency-ms", type=float, default=5)
+    args = parser.parse_args()
+    if not args.duration and args.requests <= 0:
+        parser.error("Give a --duration or a number of --requests")
+    random.seed(args.seed)
+
+    procs = spawn_stack(args) if args.spawn else []
+    try:
+        summary = asyncio.run(run(args))
+    finally:
+        stop_stack(procs)
+    report = json.dumps(summary, indent=2)
+    print(report)
+    if args.output:
+        Path(args.output).write_text(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from pathlib import Path
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Local stand-ins for the two services the API depends on, so bench_chat.py can load test the API on its own without
+# a GPU or an ES cluster. Both sleep for a configurable time to look like the real thing, and that's it. They measure
+# our overhead, not theirs.
+#
+#   python bench_fakes.py openai --port 8101 --ttft-ms 150 --tokens-per-second 40 --tokens 120
+#   python bench_fakes.py es --port 8102 --latency-ms 8 --corpus $CORPUS_JSONL_FILE
+
+WORDS = (
+    "the nameless thing that lurked beneath the gambrel roofs of arkham whispered of cyclopean "
+    "ruins and eldritch angles where no sane geometry could hold and the stars were right"
+).split()
+
+
+def fake_chunks(corpus: str | None, limit: int) -> list[dict]:
+    """
+    Search hits for the fake ES. Real chunks from the corpus if we have one so the context assembly does realistic
+    work, made up ones otherwise.
+    """
+    if corpus and Path(corpus).exists():
+        from corpus_io import iter_corpus
+
+        chunks = []
+        for doc, _ in iter_corpus(corpus):
+            doc.pop("embedding", None)
+            chunks.append(doc)
+            if len(chunks) >= limit:
+                break
+        if chunks:
+            return chunks
+    rng = random.Random(0)
+    return [
+        {
+            "source": f"story{i % 20}.txt",
+            "story_title": f"Story {i % 20}",
+            "chunk_id": i // 20,
+            "text": " ".join(rng.choices(WORDS, k=300)),
+            "start_token": (i // 20) * 250,
+            "end_token": (i // 20) * 250 + 300,
+        }
+        for i in range(limit)
+    ]
+
+
+def jittered(ms: float, jitter_ms: float) -> float:
+    return max(ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000
+
+
+def openai_app(args) -> FastAPI:
+    app = FastAPI()
+
+    def chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+        body = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(body)}\n\n"
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": args.model, "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        model = body.get("model") or args.model
+        n_tokens = min(args.tokens, body.get("max_tokens") or args.tokens)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if random.random() < args.error_rate:
+            return JSONResponse(
+                {"error": {"message": "Injected failure", "type": "server_error"}},
+                status_code=500,
+            )
+        tokens = [random.choice(WORDS) + " " for _ in range(n_tokens)]
+        per_token = 1 / args.tokens_per_second if args.tokens_per_second else 0
+
+        if body.get("stream"):
+
+            async def events():
+                await asyncio.sleep(jittered(args.ttft_ms, args.jitter_ms))
+                yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+                for token in tokens:
+                    yield chunk(completion_id, model, {"content": token})
+                    await asyncio.sleep(per_token)
+                yield chunk(completion_id, model, {}, finish_reason="stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [],
+                        "usage": {
+                            "prompt_tokens": 0,
+                            "completion_tokens": n_tokens,
+                            "total_tokens": n_tokens,
+                        },
+                    }
+                    yield f"data: {json.dumps(usage)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(
+            jittered(args.ttft_ms, args.jitter_ms) + per_token * n_tokens
+        )
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": n_tokens,
+                "total_tokens": n_tokens,
+            },
+        }
+
+    return app
+
+
+def es_app(args) -> FastAPI:
+    app = FastAPI()
+    chunks = fake_chunks(args.corpus, args.max_chunks)
+    # The official client refuses to talk to anything that doesn't say it's Elasticsearch.
+    headers = {"X-Elastic-Product": "Elasticsearch"}
+
+    def es_response(body: dict) -> JSONResponse:
+        return JSONResponse(body, headers=headers)
+
+    def search_result(body: dict, took_ms: float) -> dict:
+        size = body.get("size", 10)
+        if "knn" in body:
+            size = min(size, body["knn"].get("k", size))
+        picked = random.sample(chunks, min(size, len(chunks)))
+        hits = [
+            {
+                "_index": args.index,
+                "_id": doc.get("doc_id") or f"{doc['source']}:{doc['chunk_id']}",
+                "_score": round(1.0 - rank * 0.01, 4),
+                "_source": doc,
+            }
+            for rank, doc in enumerate(picked)
+        ]
+        return {
+            "took": int(took_ms),
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(chunks), "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            },
+        }
+
+    @app.get("/")
+    async def info():
+        return es_response(
+            {
+                "name": "bench-fake-es",
+                "cluster_name": "bench",
+                "version": {"number": "9.0.0", "build_flavor": "default"},
+                "tagline": "You Know, for Search",
+            }
+        )
+
+    @app.head("/")
+    async def ping():
+        return Response(headers=headers)
+
+    @app.head("/{index}")
+    async def index_exists(index: str):
+        return Response(headers=headers)
+
+    @app.get("/{index}/_count")
+    @app.post("/{index}/_count")
+    async def count(index: str):
+        return es_response({"count": len(chunks)})
+
+    @app.post("/{index}/_search")
+    async def search(index: str, request: Request):
+        body = json.loads(await request.body() or b"{}")
+        delay = jittered(args.latency_ms, args.jitter_ms)
+        await asyncio.sleep(delay)
+        return es_response(search_result(body, delay * 1000))
+
+    @app.post("/_msearch")
+    @app.post("/{index}/_msearch")
+    async def msearch(request: Request, index: str | None = None):
+        lines = [
+            json.loads(line)
+            for line in (await request.body()).splitlines()
+            if line.strip()
+        ]
+        # Header and body lines alternate. The searches run in parallel on a real cluster, so one delay covers all.
+        delay = jittered(args.latency_ms, args.jitter_ms)
+        await asyncio.sleep(delay)
+        responses = [
+            {**search_result(body, delay * 1000), "status": 200} for body in lines[1::2]
+        ]
+        return es_response({"took": int(delay * 1000), "responses": responses})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stand-in OpenAI compatible and Elasticsearch servers for benchmarking the API."
+    )
+    parser.add_argument("service", choices=("openai", "es"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument(
+        "--jitter-ms", type=float, default=0, help="Random +/- on every delay."
+    )
+    openai_args = parser.add_argument_group("openai")
+    openai_args.add_argument("--model", default="bench-model")
+    openai_args.add_argument(
+        "--ttft-ms", type=float, default=100, help="Delay before the first token."
+    )
+    openai_args.add_argument("--tokens-per-second", type=float, default=50)
+    openai_args.add_argument(
+        "--tokens", type=int, default=100, help="Tokens per completion."
+    )
+    openai_args.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests that get a 500.",
+    )
+    es_args = parser.add_argument_group("es")
+    es_args.add_argument("--latency-ms", type=float, default=5)
+    es_args.add_argument("--index", default="lovecraft_chunks")
+    es_args.add_argument(
+        "--corpus",
+        help="Serve real chunks from this corpus file instead of made up ones.",
+    )
+    es_args.add_argument("--max-chunks", type=int, default=1000)
+    args = parser.parse_args()
+
+    app = openai_app(args) if args.service == "openai" else es_app(args)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# Retrieval benchmark. Runs a query set through every ESSearch mode and reports how fast each one is (embedding and
+# search separately) and how good: recall@k and MRR against gold labels when the query file has them, and overlap with
+# the exact script_score results, which tells us what the approximate modes give up even without labels.
+#
+#   cd scripts && python bench_retrieval.py retrieval_queries.example.jsonl --k 5 --output retrieval.json
+#
+# The query file is either one plain query per line, or JSON lines like
+#   {"query": "Who is Wilbur Whateley?", "gold_titles": ["The Dunwich Horror"]}
+#   {"query": "...", "gold_chunks": ["the_dunwich_horror.txt:12"]}
+# where a gold chunk is "<source>:<chunk_id>".
+
+ROOT = Path(__file__).resolve().parents[1]
+# Benchmark the API's own retrieval code rather than a copy of it.
+sys.path.insert(0, str(ROOT / "src"))
+load_dotenv(dotenv_path=ROOT / ".env")
+
+from core.config import Config  # noqa: E402
+from models.chat import ChatMessage  # noqa: E402
+from models.search import SearchHit  # noqa: E402
+from services.search_service import SEARCH_MODES, ESSearch  # noqa: E402
+
+
+def load_queries(path: str) -> list[dict]:
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            query = json.loads(line) if line.startswith("{") else {"query": line}
+            query.setdefault("gold_titles", [])
+            query.setdefault("gold_chunks", [])
+            queries.append(query)
+    return queries
+
+
+def chunk_key(hit: SearchHit) -> str:
+    return f"{hit.source}:{hit.chunk_id}"
+
+
+def relevant(hit: SearchHit, query: dict) -> bool:
+    return (
+        hit.story_title in query["gold_titles"]
+        or chunk_key(hit) in query["gold_chunks"]
+    )
+
+
+def recall_at_k(hits: list[SearchHit], query: dict) -> float:
+    # Gold titles count as found if any chunk of the story comes back, gold chunks only if that exact chunk does.
+    gold = len(set(query["gold_titles"])) + len(set(query["gold_chunks"]))
+    found = {h.story_title for h in hits} & set(query["gold_titles"])
+    found |= {chunk_key(h) for h in hits} & set(query["gold_chunks"])
+    return len(found) / gold
+
+
+def reciprocal_rank(hits: list[SearchHit], query: dict) -> float:
+    for rank, hit in enumerate(hits, start=1):
+        if relevant(hit, query):
+            return 1 / rank
+    return 0.0
+
+
+def latency_stats(values_ms: list[float]) -> dict:
+    ordered = sorted(values_ms)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)], 2)
+
+    return {"p50": pct(50), "p95": pct(95), "mean": round(statistics.mean(ordered), 2)}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    config = Config()
+    # Config turns on debug logging for the whole app, which would bury the report in hit lists.
+    logging.getLogger().setLevel(logging.WARNING)
+    search = ESSearch(config)
+    queries = load_queries(args.queries)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    # The first encode loads the model, keep that out of the numbers.
+    await search.batcher.embed("warm up")
+    # Embedding doesn't depend on the mode, so every query is embedded once up front and timed on its own. This goes
+    # through the batcher but around the cache, or every run after the first would measure a dictionary lookup.
+    embed_ms, vectors = [], []
+    for query in queries:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            vector = await search.batcher.embed(query["query"])
+            embed_ms.append((time.perf_counter() - start) * 1000)
+        vectors.append(vector)
+
+    results: dict[str, list[list[SearchHit]]] = {}
+    report_modes = {}
+    # Exact goes first, it's the baseline everything else is compared with.
+    for mode in ["exact"] + [m for m in modes if m != "exact"]:
+        search.mode = mode
+        search_ms, hits_per_query = [], []
+        for query, vector in zip(queries, vectors):
+            messages = [ChatMessage(role="user", content=query["query"])]
+            for _ in range(args.warmup):
+                await search.search(messages, top_k=args.k, query_vector=vector)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                hits = await search.search(messages, top_k=args.k, query_vector=vector)
+                search_ms.append((time.perf_counter() - start) * 1000)
+            hits_per_query.append(hits)
+        results[mode] = hits_per_query
+        if mode not in modes:
+            continue
+
+        labelled = [
+            (hits, q)
+            for hits, q in zip(hits_per_query, queries)
+            if q["gold_titles"] or q["gold_chunks"]
+        ]
+        overlaps = []
+        for hits, exact_hits in zip(hits_per_query, results["exact"]):
+            exact_keys = {chunk_key(h) for h in exact_hits}
+            if exact_keys:
+                overlaps.append(
+                    len({chunk_key(h) for h in hits} & exact_keys) / len(exact_keys)
+                )
+        report_modes[mode] = {
+            "search_ms": latency_stats(search_ms),
+            "total_ms": round(
+                statistics.mean(embed_ms) + statistics.mean(search_ms), 2
+            ),
+            f"recall@{args.k}": (
+                round(statistics.mean(recall_at_k(h, q) for h, q in labelled), 4)
+                if labelled
+                else None
+            ),
+            "mrr": (
+                round(statistics.mean(reciprocal_rank(h, q) for h, q in labelled), 4)
+                if labelled
+                else None
+            ),
+            f"overlap@{args.k}_vs_exact": round(statistics.mean(overlaps), 4)
+            if overlaps
+            else None,
+        }
+
+    search.close()
+    await config.close()
+    return {
+        "commit": git_commit(),
+        "queries": len(queries),
+        "labelled_queries": sum(
+            1 for q in queries if q["gold_titles"] or q["gold_chunks"]
+        ),
+        "k": args.k,
+        "repeat": args.repeat,
+        "index": config.es_index,
+        "embedding_model": config.embedding_model,
+        "settings": {
+            "knn_k": config.es_knn_k,
+            "knn_num_candidates": config.es_knn_num_candidates,
+            "hybrid_candidates": config.es_hybrid_candidates,
+            "hybrid_bm25_weight": config.es_hybrid_bm25_weight,
+            "hybrid_knn_weight": config.es_hybrid_knn_weight,
+            "hybrid_rank_constant": config.es_hybrid_rank_constant,
+        },
+        "embed_ms": latency_stats(embed_ms),
+        "modes": report_modes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure latency and quality of every retrieval mode over a query set."
+    )
+    parser.add_argument(
+        "queries", help="Query file, plain lines or JSON lines with gold labels."
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(SEARCH_MODES),
+        help=f"Comma separated modes out of {', '.join(SEARCH_MODES)}.",
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per query.")
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Untimed runs per query and mode."
+    )
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+    unknown = [
+        m for m in args.modes.split(",") if m.strip() and m.strip() not in SEARCH_MODES
+    ]
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(unknown)}")
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        Path(args.output).write_text(report)
+
+
+if __name__ == "__main__":
+    main()
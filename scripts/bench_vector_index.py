@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from pathlib import Path
+
+from corpus_io import iter_corpus
+from index_chunks import (
+    EMBEDDING_DIMS,
+    ES_INDEX,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_M,
+    JSONL_PATH,
+    VECTOR_INDEX_TYPES,
+    create_index,
+    es,
+    force_merge,
+    load,
+    vector_mapping,
+)
+
+# Build the same corpus into one index per vector index type and measure what each one costs and how much recall it
+# gives up. Ground truth is an exact script_score over the raw float vectors, which every type keeps on disk, so the
+# recall numbers are comparable across variants.
+#
+#   cd scripts && python bench_vector_index.py --variants hnsw,int8_hnsw,bbq_hnsw --output bench.json
+
+# Bytes per vector each index type has to keep in memory for fast searches, following the ES sizing guidance. The
+# quantized types also keep the float vectors, but only on disk for rescoring.
+VECTOR_BYTES = {
+    "hnsw": lambda dims: 4 * dims,
+    "int8_hnsw": lambda dims: dims + 4,
+    "int4_hnsw": lambda dims: dims / 2 + 4,
+    "bbq_hnsw": lambda dims: dims / 8 + 14,
+}
+VECTOR_BYTES.update(
+    {name.replace("hnsw", "flat"): size for name, size in VECTOR_BYTES.items()}
+)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def estimated_memory(index_type: str, num_vectors: int, dims: int, m: int) -> int:
+    graph = num_vectors * 4 * m if index_type.endswith("hnsw") else 0
+    return int(num_vectors * VECTOR_BYTES[index_type](dims) + graph)
+
+
+def sample_queries(num_queries: int, seed: int) -> list[list[float]]:
+    # Reservoir sample of chunk embeddings, so the query vectors look exactly like the corpus without needing an encoder.
+    rng = random.Random(seed)
+    samples = []
+    for seen, (doc, _) in enumerate(iter_corpus(JSONL_PATH)):
+        if len(samples) < num_queries:
+            samples.append(doc["embedding"])
+        else:
+            slot = rng.randrange(seen + 1)
+            if slot < num_queries:
+                samples[slot] = doc["embedding"]
+    return [list(map(float, embedding)) for embedding in samples]
+
+
+def encode_queries(path: str) -> list[list[float]]:
+    from sentence_transformers import SentenceTransformer
+
+    with open(path, "r", encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    encoder = SentenceTransformer(os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-en-v1.5"))
+    return encoder.encode(queries, normalize_embeddings=True).tolist()
+
+
+def exact_ids(index: str, embedding: list[float], k: int) -> list[str]:
+    res = es.search(
+        index=index,
+        size=k,
+        source=False,
+        query={
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
+                    "params": {"query_vector": embedding},
+                },
+            }
+        },
+    )
+    return [hit["_id"] for hit in res["hits"]["hits"]]
+
+
+def knn(index: str, embedding: list[float], k: int, num_candidates: int):
+    """
+    :return: The hit ids, the wall clock latency in ms and the time ES says it took in ms
+    """
+    start = time.perf_counter()
+    res = es.search(
+        index=index,
+        size=k,
+        source=False,
+        knn={
+            "field": "embedding",
+            "query_vector": embedding,
+            "k": k,
+            "num_candidates": num_candidates,
+        },
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+    return [hit["_id"] for hit in res["hits"]["hits"]], elapsed, res["took"]
+
+
+def index_footprint(index: str) -> dict:
+    stats = es.indices.stats(index=index, metric="store,dense_vector")
+    primaries = next(iter(stats["indices"].values()))["primaries"]
+    usage = es.indices.disk_usage(index=index, run_expensive_tasks=True)
+    # The response also has a _shards entry, so look the index up by name.
+    embedding = usage[index]["fields"].get("embedding", {})
+    dense_vector = primaries.get("dense_vector", {})
+    return {
+        "store_bytes": primaries["store"]["size_in_bytes"],
+        "vector_field_bytes": embedding.get("knn_vectors_in_bytes"),
+        # Lucene keeps the vectors and graph off heap, in the page cache, so heap usage tells us nothing here. ES 9.1+
+        # reports what the vector files (raw, quantized and graph) need off heap, older versions leave this None and
+        # estimated_vector_memory_bytes is all we have.
+        "off_heap_vector_bytes": dense_vector.get("off_heap", {}).get(
+            "total_size_bytes"
+        ),
+        "dense_vector": dense_vector,
+    }
+
+
+def build_variant(index_type: str, args) -> tuple[str, dict]:
+    """
+    Load the corpus into a fresh index with the given vector index type.
+    :return: The index name and its build stats
+    """
+    index = f"{ES_INDEX}-bench-{index_type}"
+    if es.indices.exists(index=index):
+        es.indices.delete(index=index)
+    create_index(
+        index,
+        vector_mapping(
+            index_type, args.m, args.ef_construction, dims=args.dims or EMBEDDING_DIMS
+        ),
+    )
+    start = time.perf_counter()
+    stats = load(index, args, sources=None, tune=True)
+    if not args.no_force_merge:
+        force_merge(index)
+    stats["build_seconds"] = time.perf_counter() - start
+    return index, stats
+
+
+def measure_variant(index_type: str, index: str, stats: dict, queries, truth, args):
+    for embedding in queries[: args.warmup]:
+        knn(index, embedding, args.k, args.num_candidates)
+    latencies, took, recalls = [], [], []
+    for _ in range(args.runs):
+        for embedding, expected in zip(queries, truth):
+            ids, elapsed, es_took = knn(index, embedding, args.k, args.num_candidates)
+            latencies.append(elapsed)
+            took.append(es_took)
+            recalls.append(len(set(ids) & set(expected)) / max(len(expected), 1))
+    return {
+        "index_type": index_type,
+        "index": index,
+        "docs": stats["docs"],
+        "build_seconds": round(stats["build_seconds"], 2),
+        **index_footprint(index),
+        "estimated_vector_memory_bytes": estimated_memory(
+            index_type, stats["docs"], args.dims or EMBEDDING_DIMS, args.m
+        ),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+        },
+        "es_took_ms": {
+            "p50": percentile(took, 50),
+            "p95": percentile(took, 95),
+        },
+        f"recall@{args.k}": round(statistics.mean(recalls), 4),
+    }
+
+
+def print_report(results: list[dict], k: int):
+    print(
+        f"\n{'type':<12}{'store MB':>10}{'est. RAM MB':>13}{'off-heap MB':>13}{'p50 ms':>9}{'p95 ms':>9}"
+        f"{f'recall@{k}':>11}"
+    )
+    for r in results:
+        off_heap = r["off_heap_vector_bytes"]
+        off_heap = f"{off_heap / 1024 / 1024:.1f}" if off_heap is not None else "-"
+        print(
+            f"{r['index_type']:<12}{r['store_bytes'] / 1024 / 1024:>10.1f}"
+            f"{r['estimated_vector_memory_bytes'] / 1024 / 1024:>13.1f}{off_heap:>13}{r['latency_ms']['p50']:>9.2f}"
+            f"{r['latency_ms']['p95']:>9.2f}{r[f'recall@{k}']:>11.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare vector index types on index size, memory, latency and recall."
+    )
+    parser.add_argument(
+        "--variants",
+        default="hnsw,int8_hnsw,int4_hnsw,bbq_hnsw",
+        help=f"Comma separated index types out of {', '.join(VECTOR_INDEX_TYPES)}.",
+    )
+    parser.add_argument("--m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument(
+        "--dims", type=int, default=None, help="Defaults to EMBEDDING_DIMS."
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument(
+        "--queries-file",
+        help="Text queries, one per line, embedded with EMBEDDING_MODEL. Without it, chunk embeddings sampled "
+        "from the corpus are used as queries.",
+    )
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=3, help="Passes over the queries.")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the bench indexes afterwards."
+    )
+    parser.add_argument("--no-force-merge", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    # Bulk loading, see index_chunks.py
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--max-chunk-bytes", type=int, default=20 * 1024 * 1024)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--initial-backoff", type=float, default=2.0)
+    parser.add_argument("--max-backoff", type=float, default=60.0)
+    args = parser.parse_args()
+
+    variants = [v.strip() for v in args.variants.split(",") if v.strip()]
+    unknown = [v for v in variants if v not in VECTOR_INDEX_TYPES]
+    if unknown:
+        parser.error(f"Unknown index types: {', '.join(unknown)}")
+    if not JSONL_PATH or not Path(JSONL_PATH).exists():
+        raise FileNotFoundError(f"CORPUS_JSONL_FILE not found: {JSONL_PATH}")
+    if not es.ping():
+        raise ConnectionError("Failed to connect to Elasticsearch")
+
+    if args.queries_file:
+        queries = encode_queries(args.queries_file)
+    else:
+        queries = sample_queries(args.num_queries, args.seed)
+    print(f"Benchmarking {', '.join(variants)} with {len(queries)} queries")
+
+    results = []
+    truth = None
+    for index_type in variants:
+        index, stats = build_variant(index_type, args)
+        if truth is None:
+            # The exact neighbours only depend on the float vectors, so they're computed once, on the first index.
+            truth = [exact_ids(index, q, args.k) for q in queries]
+        results.append(measure_variant(index_type, index, stats, queries, truth, args))
+        if not args.keep:
+            es.indices.delete(index=index)
+
+    print_report(results, args.k)
+    if args.output:
+        report = {
+            "corpus": JSONL_PATH,
+            "queries": len(queries),
+            "k": args.k,
+            "num_candidates": args.num_candidates,
+            "m": args.m,
+            "ef_construction": args.ef_construction,
+            "results": results,
+        }
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
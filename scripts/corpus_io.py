@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Bump this if the layout of the chunk records changes in a way that should force a full rebuild.
+MANIFEST_VERSION = 1
+
+
+def manifest_path(corpus_path: str | Path) -> Path:
+    """
+    The manifest lives next to the corpus jsonl unless CORPUS_MANIFEST_FILE says otherwise.
+    """
+    override = os.getenv("CORPUS_MANIFEST_FILE")
+    if override:
+        return Path(override)
+    corpus_path = Path(corpus_path)
+    return corpus_path.with_name(corpus_path.name + ".manifest.json")
+
+
+def load_manifest(path: Path) -> dict | None:
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path: Path, manifest: dict):
+    # Write then rename so a crash never leaves a half written manifest that claims stories are done.
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_doc_id(source: str, chunk_id: int) -> str:
+    """
+    Deterministic document ID for a chunk, so re-indexing a story overwrites its chunks instead of duplicating them.
+    """
+    return hashlib.sha1(f"{source}:{chunk_id}".encode("utf-8")).hexdigest()
+
+
+_decoder = json.JSONDecoder()
+_SOURCE_PREFIX = '{"source": '
+
+
+def record_source(line: str) -> str:
+    """
+    Pull the story source out of a corpus line without parsing the (large) embedding. prep_docs writes "source" as
+    the first key, so we only need to decode that one string.
+    """
+    if line.startswith(_SOURCE_PREFIX):
+        return _decoder.raw_decode(line, len(_SOURCE_PREFIX))[0]
+    return json.loads(line)["source"]
+
+
+# == Corpus layouts ==
+# "jsonl" is one JSON record per chunk with the embedding inline as a list of decimal floats. Simple, but a 768 dim
+# embedding is ~15 KB of text per chunk and every reader has to json.loads all of it.
+# "npy" keeps the same records minus the embedding in CORPUS_JSONL_FILE, and the embeddings as one float32 (or
+# float16) matrix in <CORPUS_JSONL_FILE>.embeddings.npy, row i belonging to line i. The matrix is memory-mapped on
+# read, so loading it is no work at all.
+CORPUS_FORMATS = ("jsonl", "npy")
+EMBEDDING_DTYPES = ("float32", "float16")
+EMBEDDINGS_SUFFIX = ".embeddings.npy"
+
+
+def embeddings_path(corpus_path: str | Path) -> Path:
+    corpus_path = Path(corpus_path)
+    return corpus_path.with_name(corpus_path.name + EMBEDDINGS_SUFFIX)
+
+
+def is_compact(corpus_path: str | Path) -> bool:
+    return embeddings_path(corpus_path).exists()
+
+
+def iter_corpus(path: str | Path, sources: set[str] | None = None):
+    """
+    Stream the chunk records of a corpus in either layout, optionally only those of the given stories.
+    :param path: The CORPUS_JSONL_FILE
+    :param sources: Only yield chunks of these stories. Others are skipped without parsing them.
+    :return: A generator of (record, size) pairs. The record's embedding is a list for a jsonl corpus and a row of the
+        memory-mapped matrix for an npy one. size is the number of bytes the record takes on disk.
+    """
+    matrix = np.load(embeddings_path(path), mmap_mode="r") if is_compact(path) else None
+    row = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row += 1
+            if sources is not None and record_source(line) not in sources:
+                continue
+            doc = json.loads(line)
+            size = len(line)
+            if matrix is not None:
+                doc["embedding"] = matrix[row - 1]
+                size += doc["embedding"].nbytes
+            yield doc, size
+
+
+def count_records(path: str | Path) -> int:
+    """
+    Count the chunks in a corpus without parsing any of them. For an npy corpus the matrix has to agree.
+    """
+    with open(path, "rb") as f:
+        count = sum(1 for line in f if line.strip())
+    if is_compact(path):
+        rows = np.load(embeddings_path(path), mmap_mode="r").shape[0]
+        if rows != count:
+            raise ValueError(
+                f"{embeddings_path(path)} has {rows} rows but {path} has {count} records"
+            )
+    return count
+
+
+class CorpusWriter:
+    """
+    Writes chunk records in either layout. Everything goes to temp files that only replace the corpus in commit(), so
+    an interrupted run leaves the old corpus in place.
+
+    For the npy layout the rows are appended to the matrix as they come and the .npy header is rewritten with the
+    final row count at the end. NumPy leaves room in the header for exactly that, so we never need to know the number
+    of chunks up front or hold the embeddings in memory.
+    """
+
+    def __init__(self, path: str | Path, fmt: str = "jsonl", dtype: str = "float32"):
+        if fmt not in CORPUS_FORMATS:
+            raise ValueError(
+                f"CORPUS_FORMAT must be one of {CORPUS_FORMATS}, not '{fmt}'"
+            )
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(
+                f"CORPUS_EMBEDDING_DTYPE must be one of {EMBEDDING_DTYPES}, not '{dtype}'"
+            )
+        self.path = Path(path)
+        self.compact = fmt == "npy"
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.rows = 0
+        self._dims = None
+        self._tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self._tmp_embeddings = embeddings_path(self._tmp_path)
+        self._meta_f = open(self._tmp_path, "w", encoding="utf-8")
+        self._emb_f = open(self._tmp_embeddings, "wb") if self.compact else None
+
+    def _header(self) -> dict:
+        return {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.rows, self._dims),
+        }
+
+    def write(self, doc: dict):
+        """
+        Write one chunk record. The embedding can be a list or an array.
+        """
+        if not self.compact:
+            embedding = doc["embedding"]
+            if isinstance(embedding, np.ndarray):
+                doc = {**doc, "embedding": embedding.tolist()}
+            self._meta_f.write(json.dumps(doc) + "\n")
+            return
+        embedding = np.asarray(doc["embedding"], dtype=self.dtype)
+        if self._dims is None:
+            self._dims = embedding.shape[0]
+            np.lib.format.write_array_header_1_0(self._emb_f, self._header())
+        elif embedding.shape[0] != self._dims:
+            raise ValueError(
+                f"Embedding of {doc['source']} chunk {doc['chunk_id']} has {embedding.shape[0]} dims, expected {self._dims}"
+            )
+        self._emb_f.write(embedding.tobytes())
+        self._meta_f.write(
+            json.dumps({k: v for k, v in doc.items() if k != "embedding"}) + "\n"
+        )
+        self.rows += 1
+
+    def write_line(self, line: str):
+        """
+        Copy a record line from a jsonl corpus as it is, which skips parsing it entirely. Only valid for jsonl output.
+        """
+        self._meta_f.write(line)
+
+    def commit(self):
+        self._meta_f.close()
+        if self.compact:
+            if self._dims is None:
+                # No chunks at all. Still write a valid (empty) matrix so readers see an npy corpus.
+                self._dims = 0
+                np.lib.format.write_array_header_1_0(self._emb_f, self._header())
+            header_size = (
+                self._emb_f.tell() - self.rows * self._dims * self.dtype.itemsize
+            )
+            self._emb_f.seek(0)
+            np.lib.format.write_array_header_1_0(self._emb_f, self._header())
+            if self._emb_f.tell() != header_size:
+                raise RuntimeError(
+                    "The .npy header changed size when rewriting the row count"
+                )
+            self._emb_f.close()
+            os.replace(self._tmp_embeddings, embeddings_path(self.path))
+        os.replace(self._tmp_path, self.path)
+        if not self.compact:
+            # Don't leave a matrix from an earlier npy run around, readers would take this for an npy corpus.
+            embeddings_path(self.path).unlink(missing_ok=True)
+
+    def abort(self):
+        self._meta_f.close()
+        self._tmp_path.unlink(missing_ok=True)
+        if self._emb_f is not None:
+            self._emb_f.close()
+            self._tmp_embeddings.unlink(missing_ok=True)
@@ -1,11 +1,19 @@
-import json
+import argparse
 import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
 from pathlib import Path
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch, helpers
 import ssl
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
+from corpus_io import chunk_doc_id, iter_corpus, load_manifest, manifest_path
 
 # We're filtering this warning because we're running ElasticSearch in an insecure local dev mode. Without this
 # we end up getting a swarm of warnings that aren't helping in this case.
@@ -22,9 +30,12 @@ ES_HOST = os.getenv("ES_HOST")
 ES_INDEX = os.getenv("ES_INDEX")
 ES_USER = os.getenv("ES_USER")
 ES_PASS = os.getenv("ES_PASSWORD")
-
-if not JSONL_PATH or not Path(JSONL_PATH).exists():
-    raise FileNotFoundError(f"CORPUS_JSONL_FILE not found: {JSONL_PATH}")
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "768"))
+# How the embedding field is indexed. Leave the type empty to get the ES default for the version you're running.
+VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "")
+VECTOR_ELEMENT_TYPE = os.getenv("ES_VECTOR_ELEMENT_TYPE", "float")
+HNSW_M = int(os.getenv("ES_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("ES_HNSW_EF_CONSTRUCTION", "100"))
 
 # Set up Elasticsearch client
 es = Elasticsearch(
@@ -32,15 +43,79 @@ es = Elasticsearch(
 )
 
 
-# Create index if not exists
-def create_index():
-    if es.indices.exists(index=ES_INDEX):
-        print(f"Index '{ES_INDEX}' already exists.")
-        return
+# Fields the incremental indexer relies on. They're added to older indexes that predate them.
+ID_FIELDS = {
+    "doc_id": {"type": "keyword"},
+    "content_hash": {"type": "keyword"},
+}
+
+
+# The quantized types keep the float vectors on disk for rescoring but only need the quantized copy (and the graph) in
+# memory: int8 is ~4x smaller than float, int4 ~8x, and bbq (one bit per dimension) ~32x.
+VECTOR_INDEX_TYPES = (
+    "hnsw",
+    "int8_hnsw",
+    "int4_hnsw",
+    "bbq_hnsw",
+    "flat",
+    "int8_flat",
+    "int4_flat",
+    "bbq_flat",
+)
+QUANTIZED_INDEX_TYPES = {t for t in VECTOR_INDEX_TYPES if t not in ("hnsw", "flat")}
 
-    print(f"Creating index '{ES_INDEX}'...")
+
+def vector_mapping(
+    index_type: str = VECTOR_INDEX_TYPE,
+    m: int = HNSW_M,
+    ef_construction: int = HNSW_EF_CONSTRUCTION,
+    element_type: str = VECTOR_ELEMENT_TYPE,
+    dims: int = EMBEDDING_DIMS,
+) -> dict:
+    """
+    Mapping for the embedding field.
+    :param index_type: One of VECTOR_INDEX_TYPES, or empty for the ES default
+    :param m: HNSW neighbours per node. More means better recall and a bigger graph.
+    :param ef_construction: HNSW candidates considered while building. More means better recall and slower indexing.
+    :param element_type: float, byte or bit. Quantization only applies to float vectors.
+    :param dims:
+    :return: The dense_vector mapping
+    """
+    mapping = {
+        "type": "dense_vector",
+        "dims": dims,
+        "element_type": element_type,
+        "index": True,
+        "similarity": "cosine",
+    }
+    if not index_type:
+        return mapping
+    if index_type not in VECTOR_INDEX_TYPES:
+        raise ValueError(
+            f"ES_VECTOR_INDEX_TYPE must be one of {VECTOR_INDEX_TYPES}, not '{index_type}'"
+        )
+    if index_type in QUANTIZED_INDEX_TYPES and element_type != "float":
+        raise ValueError(
+            f"{index_type} quantizes float vectors, it can't be used with element_type {element_type}"
+        )
+    mapping["index_options"] = {"type": index_type}
+    if index_type.endswith("hnsw"):
+        mapping["index_options"].update(m=m, ef_construction=ef_construction)
+    return mapping
+
+
+# Create index if not exists. Returns True if we just created it. meta goes into the mapping's _meta.
+def create_index(
+    index: str, embedding_mapping: dict | None = None, meta: dict | None = None
+) -> bool:
+    if es.indices.exists(index=index):
+        print(f"Index '{index}' already exists.")
+        es.indices.put_mapping(index=index, properties=ID_FIELDS)
+        return False
+
+    print(f"Creating index '{index}'...")
     es.indices.create(
-        index=ES_INDEX,
+        index=index,
         body={
             "mappings": {
                 "properties": {
@@ -50,35 +125,465 @@ def create_index():
                     "source": {"type": "keyword"},
                     "start_token": {"type": "integer"},
                     "end_token": {"type": "integer"},
-                    "embedding": {
-                        "type": "dense_vector",
-                        "dims": 768,
-                        "index": True,
-                        "similarity": "cosine",
-                    },
-                }
+                    **ID_FIELDS,
+                    "embedding": embedding_mapping or vector_mapping(),
+                },
+                **({"_meta": meta} if meta else {}),
             }
         },
     )
+    return True
+
+
+def indexed_story_hashes(index: str) -> dict[str, set]:
+    """
+    Ask ES which content hashes it currently holds for each story, paging through a composite aggregation so this
+    works for any number of stories. Chunks indexed before content hashes existed show up as None.
+    """
+    state: dict[str, set] = {}
+    after = None
+    while True:
+        composite = {
+            "size": 1000,
+            "sources": [
+                {"source": {"terms": {"field": "source"}}},
+                {"hash": {"terms": {"field": "content_hash", "missing_bucket": True}}},
+            ],
+        }
+        if after:
+            composite["after"] = after
+        res = es.search(index=index, size=0, aggs={"stories": {"composite": composite}})
+        agg = res["aggregations"]["stories"]
+        for bucket in agg["buckets"]:
+            state.setdefault(bucket["key"]["source"], set()).add(bucket["key"]["hash"])
+        after = agg.get("after_key")
+        if not agg["buckets"] or not after:
+            return state
 
 
 # Generator for bulk indexing
-def generate_docs():
-    with open(JSONL_PATH, "r", encoding="utf-8") as f:
-        for line in f:
-            doc = json.loads(line)
-            yield {"_op_type": "index", "_index": ES_INDEX, "_source": doc}
+def generate_docs(
+    index: str, sources: set[str] | None = None, stats: dict | None = None
+):
+    """
+    Yield index actions for the corpus, or only for the given stories. The _id is derived from the story and chunk
+    number so re-running overwrites chunks instead of piling up duplicates. If stats is given it collects the number
+    of documents and bytes read plus a small random sample of documents for validating the result.
+    """
+    for doc, size in iter_corpus(JSONL_PATH, sources):
+        # Rows of an npy corpus come out as arrays. The client's JSON serializer wants plain lists.
+        if not isinstance(doc["embedding"], list):
+            doc["embedding"] = doc["embedding"].tolist()
+        doc_id = doc.get("doc_id") or chunk_doc_id(doc["source"], doc["chunk_id"])
+        if stats is not None:
+            stats["bytes"] += size
+            stats["docs"] += 1
+            sample_doc(stats, doc_id, doc)
+        yield {
+            "_op_type": "index",
+            "_index": index,
+            "_id": doc_id,
+            "_source": doc,
+        }
+
+
+def sample_doc(stats: dict, doc_id: str, doc: dict, size: int = 5):
+    # Reservoir sampling, so the validation queries come from all over the corpus without holding it in memory.
+    samples = stats.setdefault("samples", [])
+    if len(samples) < size:
+        samples.append((doc_id, doc["embedding"]))
+    else:
+        slot = random.randrange(stats["docs"])
+        if slot < size:
+            samples[slot] = (doc_id, doc["embedding"])
+
+
+def delete_stale_chunks(
+    index: str, wanted: dict[str, str], changed: set[str], removed: set[str]
+):
+    """
+    After the upsert, drop chunks that no longer belong: leftovers of a changed story that now has fewer chunks (or
+    was indexed before it had a content hash), and every chunk of stories that left the corpus.
+    """
+    for source in sorted(changed):
+        res = es.delete_by_query(
+            index=index,
+            query={
+                "bool": {
+                    "filter": [{"term": {"source": source}}],
+                    "must_not": [{"term": {"content_hash": wanted[source]}}],
+                }
+            },
+            conflicts="proceed",
+            refresh=True,
+        )
+        if res["deleted"]:
+            print(f"Deleted {res['deleted']} stale chunks of '{source}'")
+    if removed:
+        res = es.delete_by_query(
+            index=index,
+            query={"terms": {"source": sorted(removed)}},
+            conflicts="proceed",
+            refresh=True,
+        )
+        print(f"Deleted {res['deleted']} chunks of {len(removed)} removed stories")
+
+
+@contextmanager
+def bulk_load_settings(index: str):
+    """
+    While we bulk load, turn off periodic refreshes and replicas. Nobody needs to search half a load, and not
+    refreshing or copying every batch to replicas makes a big difference to ingest speed. The previous values are
+    put back afterwards, even if the load fails.
+    """
+    current = es.indices.get_settings(index=index, flat_settings=True)
+    current = next(iter(current.values()))["settings"]
+    previous = {
+        "index.refresh_interval": current.get("index.refresh_interval"),
+        "index.number_of_replicas": current.get("index.number_of_replicas", "1"),
+    }
+    es.indices.put_settings(
+        index=index,
+        settings={"index.refresh_interval": "-1", "index.number_of_replicas": 0},
+    )
+    try:
+        yield
+    finally:
+        # A refresh_interval of None resets it to the ES default.
+        es.indices.put_settings(index=index, settings=previous)
+        es.indices.refresh(index=index)
+
+
+def bulk_index(actions, args) -> tuple[int, list]:
+    """
+    Load the actions with several streaming_bulk workers pulling from the same generator. Each worker sends its own
+    batches, so ES gets `threads` bulk requests in flight, and streaming_bulk retries documents rejected with a 429
+    (a full write queue) with exponential backoff instead of failing the load.
+    :return: The number of documents indexed and the list of errors
+    """
+    lock = threading.Lock()
+    progress = {"ok": 0, "errors": []}
+
+    def shared_actions():
+        while True:
+            with lock:
+                action = next(actions, None)
+            if action is None:
+                return
+            yield action
+
+    def worker():
+        for ok, info in helpers.streaming_bulk(
+            es,
+            shared_actions(),
+            chunk_size=args.chunk_size,
+            max_chunk_bytes=args.max_chunk_bytes,
+            max_retries=args.max_retries,
+            initial_backoff=args.initial_backoff,
+            max_backoff=args.max_backoff,
+            raise_on_error=False,
+        ):
+            with lock:
+                if ok:
+                    progress["ok"] += 1
+                else:
+                    progress["errors"].append(info)
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for future in [pool.submit(worker) for _ in range(args.threads)]:
+            future.result()
+    return progress["ok"], progress["errors"]
+
+
+def load(index: str, args, sources: set[str] | None, tune: bool) -> dict:
+    """
+    Stream the corpus (or just the given stories) into an index.
+    :return: Load stats: documents and bytes read, a sample of documents, documents indexed and errors
+    """
+    print(f"Indexing chunks from {JSONL_PATH} into '{index}'...")
+    stats = {"bytes": 0, "docs": 0}
+    actions = generate_docs(index, sources, stats)
+    start = time.perf_counter()
+    with bulk_load_settings(index) if tune else nullcontext():
+        stats["indexed"], stats["errors"] = bulk_index(actions, args)
+    elapsed = time.perf_counter() - start
+    es.indices.refresh(index=index)
+    print(
+        f"Indexed {stats['indexed']} documents in {elapsed:.1f}s: {stats['indexed'] / elapsed:.0f} docs/s, "
+        f"{stats['bytes'] / elapsed / 1024 / 1024:.1f} MB/s"
+    )
+    if stats["errors"]:
+        print(
+            f"{len(stats['errors'])} documents failed, first error: {stats['errors'][0]}"
+        )
+    return stats
+
+
+def force_merge(index: str):
+    print(f"Force merging '{index}'...")
+    es.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+
+
+# == Blue/green rebuilds ==
+# ES_INDEX is a read alias. Every rebuild goes into a new physical index named ES_INDEX-v<timestamp> while the alias
+# keeps serving the current one, and the alias only moves once the new index checks out. The swap is a single atomic
+# update_aliases call, so searches never see a missing or half built index.
+#
+# Each build records how it went in its mapping's _meta: "building" while it loads, then "validated" or "failed". Only
+# validated builds (and ones from before we kept track) count as versions, so a failed or interrupted build is never
+# rolled back to and never pushes a good version out of retention.
+BUILD_STATUS = "build_status"
+
+
+def set_build_status(index: str, status: str):
+    es.indices.put_mapping(index=index, meta={BUILD_STATUS: status})
+
+
+def build_statuses() -> dict[str, str | None]:
+    """Every versioned index with its build status, None for builds from before it was recorded."""
+    mappings = es.indices.get_mapping(index=f"{ES_INDEX}-v*", expand_wildcards="open")
+    return {
+        index: body["mappings"].get("_meta", {}).get(BUILD_STATUS)
+        for index, body in mappings.items()
+    }
+
+
+def version_indices() -> list[str]:
+    """Good builds behind the alias, oldest first. The timestamped names sort chronologically."""
+    return sorted(
+        index
+        for index, status in build_statuses().items()
+        if status in (None, "validated")
+    )
+
+
+def alias_targets() -> list[str]:
+    if not es.indices.exists_alias(name=ES_INDEX):
+        return []
+    return list(es.indices.get_alias(name=ES_INDEX))
+
+
+def validate_index(index: str, stats: dict, min_sample_hits: float = 0.8) -> bool:
+    """
+    Sanity check a freshly built index before it takes traffic: every document in the corpus has to be there, and
+    searching with a sampled chunk's own embedding has to bring that chunk back as the top hit for most of the samples.
+    """
+    count = es.count(index=index)["count"]
+    if count != stats["docs"]:
+        print(
+            f"Validation failed: '{index}' holds {count} documents, the corpus has {stats['docs']}"
+        )
+        return False
+    samples = stats.get("samples", [])
+    found = 0
+    for doc_id, embedding in samples:
+        res = es.search(
+            index=index,
+            size=1,
+            source=False,
+            knn={
+                "field": "embedding",
+                "query_vector": embedding,
+                "k": 10,
+                "num_candidates": 100,
+            },
+        )
+        hits = res["hits"]["hits"]
+        found += bool(hits) and hits[0]["_id"] == doc_id
+    if samples and found / len(samples) < min_sample_hits:
+        print(
+            f"Validation failed: only {found}/{len(samples)} sample chunks found themselves"
+        )
+        return False
+    print(
+        f"Validation passed: {count} documents, {found}/{len(samples)} sample queries ok"
+    )
+    return True
+
+
+def swap_alias(new_index: str):
+    """
+    Point the alias at new_index in one atomic step. If ES_INDEX is still an old style concrete index it gets removed
+    in the same step so the alias can take its name.
+    """
+    actions = [{"remove": {"index": old, "alias": ES_INDEX}} for old in alias_targets()]
+    if es.indices.exists(index=ES_INDEX) and not es.indices.exists_alias(name=ES_INDEX):
+        print(f"Replacing the concrete index '{ES_INDEX}' with an alias")
+        actions.append({"remove_index": {"index": ES_INDEX}})
+    actions.append({"add": {"index": new_index, "alias": ES_INDEX}})
+    es.indices.update_aliases(actions=actions)
+    print(f"Alias '{ES_INDEX}' now points at '{new_index}'")
+
+
+def apply_retention(retain: int):
+    """Keep the live index plus the `retain` most recent older versions for rollback, and delete the rest."""
+    live = set(alias_targets())
+    older = [index for index in version_indices() if index not in live]
+    for index in older[: max(len(older) - retain, 0)]:
+        print(f"Deleting old version '{index}'")
+        es.indices.delete(index=index)
+    # Failed builds are kept for inspection and don't count towards retention, so they're left for you to delete.
+    unfinished = sorted(
+        index
+        for index, status in build_statuses().items()
+        if status not in (None, "validated")
+    )
+    if unfinished:
+        print(
+            f"Failed or unfinished builds not touched by retention: {', '.join(unfinished)}"
+        )
+
+
+def rebuild(args):
+    new_index = f"{ES_INDEX}-v{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+    create_index(new_index, meta={BUILD_STATUS: "building"})
+    stats = load(new_index, args, sources=None, tune=not args.no_tune)
+    if stats["errors"] or not validate_index(new_index, stats):
+        set_build_status(new_index, "failed")
+        print(
+            f"Leaving '{ES_INDEX}' as it was. The failed build is kept as '{new_index}' for inspection."
+        )
+        sys.exit(1)
+    if args.force_merge:
+        force_merge(new_index)
+    set_build_status(new_index, "validated")
+    swap_alias(new_index)
+    apply_retention(args.retain)
+
+
+def rollback():
+    live = alias_targets()
+    versions = version_indices()
+    previous = [index for index in versions if live and index < min(live)]
+    if not previous:
+        print(f"No older version of '{ES_INDEX}' to roll back to.")
+        sys.exit(1)
+    swap_alias(previous[-1])
+
+
+def incremental(args):
+    """
+    Upsert only the stories that changed into whatever the alias currently points at.
+    """
+    created = create_index(ES_INDEX)
+
+    # The manifest written by prep_docs says which content hash every story should have. Comparing it with what ES
+    # holds tells us exactly which stories to (re)index and which to delete.
+    manifest = load_manifest(manifest_path(JSONL_PATH))
+    if manifest is None:
+        print("No corpus manifest found, indexing every chunk.")
+        sources, wanted, changed, removed = None, {}, set(), set()
+    else:
+        # Stories that produced no chunks (empty files) have nothing to index.
+        wanted = {
+            name: story["hash"]
+            for name, story in manifest["stories"].items()
+            if story.get("chunks")
+        }
+        indexed = indexed_story_hashes(ES_INDEX)
+        if args.full:
+            sources = set(wanted)
+        else:
+            sources = {
+                name
+                for name, content_hash in wanted.items()
+                if indexed.get(name) != {content_hash}
+            }
+        changed = sources & set(indexed)
+        removed = set(indexed) - set(wanted)
+        print(
+            f"{len(wanted)} stories in the corpus: {len(sources)} to index, "
+            f"{len(wanted) - len(sources)} up to date, {len(removed)} to remove"
+        )
+
+    if sources is None or sources:
+        # Only take the index out of its normal search settings for a full load, and only when nothing is searching it
+        # yet: we just created it, or it isn't behind the alias the API reads. A full load into the live index would
+        # leave searches without fresh results or replicas for its whole duration. Use --rebuild for that instead.
+        serving = not created and es.indices.exists_alias(name=ES_INDEX)
+        tune = not args.no_tune and (args.full or sources is None) and not serving
+        if serving and (args.full or sources is None):
+            print(f"'{ES_INDEX}' is serving traffic, loading without ingest tuning.")
+        stats = load(ES_INDEX, args, sources, tune)
+        if stats["errors"]:
+            # Don't delete stale chunks when their replacements may not have made it in.
+            sys.exit(1)
+    delete_stale_chunks(ES_INDEX, wanted, changed, removed)
+
+    if args.force_merge:
+        force_merge(ES_INDEX)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Index the chunk corpus into ElasticSearch."
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-index every chunk in place instead of only the stories that changed.",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="Concurrent bulk requests."
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="Documents per bulk request."
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        type=int,
+        default=20 * 1024 * 1024,
+        help="Upper bound on the size of one bulk request.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="Retries for documents rejected because ES is overloaded (429).",
+    )
+    parser.add_argument("--initial-backoff", type=float, default=2.0)
+    parser.add_argument("--max-backoff", type=float, default=60.0)
+    parser.add_argument(
+        "--no-tune",
+        action="store_true",
+        help="Leave refresh_interval and replicas alone during a full load. They're only ever changed on an index "
+        "that isn't serving traffic: a --rebuild, or one that was just created or isn't behind the alias.",
+    )
+    parser.add_argument(
+        "--force-merge",
+        action="store_true",
+        help="Force merge down to one segment after loading. Faster searches, slow to run.",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build a new versioned index in the background, validate it and atomically swap the alias over.",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Point the alias back at the previous version.",
+    )
+    parser.add_argument(
+        "--retain",
+        type=int,
+        default=2,
+        help="Older versions to keep around for rollback after a rebuild.",
+    )
+    args = parser.parse_args()
+
     if not es.ping():
         raise ConnectionError("Failed to connect to Elasticsearch")
-
-    create_index()
-
-    print(f"Indexing chunks from {JSONL_PATH} into '{ES_INDEX}'...")
-    result = helpers.bulk(es, generate_docs())
-    print(f"Indexed {result[0]} documents successfully.")
+    if args.rollback:
+        rollback()
+        return
+    if not JSONL_PATH or not Path(JSONL_PATH).exists():
+        raise FileNotFoundError(f"CORPUS_JSONL_FILE not found: {JSONL_PATH}")
+    # The very first load is always a blue/green build so ES_INDEX starts out life as an alias.
+    if args.rebuild or not es.indices.exists(index=ES_INDEX):
+        rebuild(args)
+    else:
+        incremental(args)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
-import json
+import argparse
 import os
+import time
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 from pathlib import Path
 from typing import List, Dict
 import spacy
@@ -8,6 +11,18 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 import re
 import logging
+from corpus_io import (
+    MANIFEST_VERSION,
+    CorpusWriter,
+    chunk_doc_id,
+    file_hash,
+    is_compact,
+    iter_corpus,
+    load_manifest,
+    manifest_path,
+    record_source,
+    save_manifest,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -17,15 +32,48 @@ load_dotenv(dotenv_path=Path(__file__).resolve().parents[1] / ".env")
 INPUT_FILE_DIR = os.getenv("CORPUS_RAW_FILE_DIR")
 OUTPUT_FILE = os.getenv("CORPUS_JSONL_FILE")
 SPACY_MODEL = os.getenv("SPACY_MODEL")
-MAX_TOKENS = 400
-OVERLAP = 50
-MODEL = "BAAI/bge-base-en-v1.5"
+MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+# How much consecutive chunks share, counted in tokens or in whole sentences depending on OVERLAP_UNIT.
+OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+OVERLAP_UNIT = os.getenv("CHUNK_OVERLAP_UNIT", "tokens")
+MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-base-en-v1.5")
+# "jsonl" writes embeddings inline as JSON floats, "npy" writes them to a separate memory-mappable matrix (see corpus_io).
+CORPUS_FORMAT = os.getenv("CORPUS_FORMAT", "jsonl")
+EMBEDDING_DTYPE = os.getenv("CORPUS_EMBEDDING_DTYPE", "float32")
 
-# Load NLP and tokenizer
+# Loaded by load_models() from main rather than at import time. spaCy worker processes re-import this module when
+# they're spawned rather than forked (the default on macOS), and we don't want each of them loading the encoder.
+nlp = None
+encoder = None
+tokenizer = None
 
-nlp = spacy.load(SPACY_MODEL)
-encoder = SentenceTransformer(MODEL)
-tokenizer = encoder.tokenizer
+
+def load_sentence_pipeline(model_name: str):
+    """
+    We only need sentence boundaries, so load the spaCy pipeline without the tagger, lemmatizer, NER and parser and
+    use the much cheaper statistical sentence recognizer (senter) instead. Falls back to the rule based sentencizer for
+    pipelines that don't ship a senter.
+    """
+    pipeline = spacy.load(
+        model_name, exclude=["tagger", "attribute_ruler", "lemmatizer", "ner", "parser"]
+    )
+    if "senter" in pipeline.component_names:
+        pipeline.enable_pipe("senter")
+    else:
+        pipeline.add_pipe("sentencizer")
+    # The senter in the trained English pipelines has its own embedding layer, so the shared tok2vec is dead weight.
+    if "tok2vec" in pipeline.pipe_names:
+        listeners = pipeline.get_pipe("tok2vec").listening_components
+        if not any(name in pipeline.pipe_names for name in listeners):
+            pipeline.disable_pipe("tok2vec")
+    return pipeline
+
+
+def load_models():
+    global nlp, encoder, tokenizer
+    nlp = load_sentence_pipeline(SPACY_MODEL)
+    encoder = SentenceTransformer(MODEL)
+    tokenizer = encoder.tokenizer
 
 
 # Utility: extract title from first line
@@ -36,82 +84,276 @@ def extract_title(first_line: str) -> str:
     return "Unknown Title"
 
 
-def count_tokens(text: str) -> int:
-    return len(tokenizer.encode(text, add_special_tokens=False))
+def sentence_token_counts(sentences: List[str]) -> List[int]:
+    # One call to the fast tokenizer's batch API for the whole story instead of an encode per sentence.
+    encoded = tokenizer(
+        sentences,
+        add_special_tokens=False,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )
+    return [len(ids) for ids in encoded["input_ids"]]
 
 
-def chunk_and_embed_story(text: str, title: str, source_file: str) -> List[Dict]:
-    doc = nlp(text)
-    chunks = []
-    current_chunk = []
-    current_tokens = 0
-    start_token = 0
+def chunk_windows(
+    token_counts: List[int], max_tokens: int, overlap: int, overlap_unit: str
+) -> List[tuple[int, int]]:
+    """
+    Work out chunk boundaries as [start, end) sentence index ranges using prefix sums of the sentence token counts.
+    Each window takes as many whole sentences as fit in max_tokens (always at least one, so a monster sentence becomes
+    its own oversized chunk). The next window starts far enough back to share up to `overlap` tokens, or exactly
+    `overlap` sentences, with the previous one, but always at least one sentence further on so we can't get stuck.
+    Each boundary is a binary search, so the whole thing is linear-ish in the number of sentences and the result only
+    depends on the token counts.
+    """
+    prefix = list(accumulate(token_counts, initial=0))
+    n = len(token_counts)
+    windows = []
+    start = 0
+    while start < n:
+        end = bisect_right(prefix, prefix[start] + max_tokens, lo=start + 1) - 1
+        end = max(end, start + 1)
+        windows.append((start, end))
+        if end >= n:
+            break
+        if overlap_unit == "sentences":
+            next_start = end - overlap
+        else:
+            next_start = bisect_left(
+                prefix, prefix[end] - overlap, lo=start + 1, hi=end
+            )
+        start = max(next_start, start + 1)
+    return windows
 
-    def chunk_text():
-        nonlocal start_token
-        chunk_str = " ".join(current_chunk)
-        end_token = start_token + current_tokens
-        embedding = encoder.encode(chunk_str, normalize_embeddings=True).tolist()
-        result = {
-            "story_title": title,
-            "text": chunk_str,
-            "chunk_id": len(chunks),
+
+def read_story(file_path: Path) -> tuple[str, str] | None:
+    with open(file_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    if not lines:
+        logger.warning(f"There are no lines in the file: {file_path.name}")
+        return None
+    title_line = lines[0].strip()
+    story_text = "".join(lines[1:]).strip()
+    return story_text, extract_title(title_line)
+
+
+def chunk_story(
+    sentences: List[str], title: str, source_file: str, content_hash: str
+) -> List[Dict]:
+    """
+    Slide a window of whole sentences over the story. Every sentence is tokenized exactly once and the windows come
+    from prefix sums of those counts, so re-chunking the overlap never costs another tokenizer pass. Embedding happens
+    later, in large batches across stories, so the chunks come back without one.
+
+    "source" is deliberately the first key so incremental runs can sort lines by story without parsing embeddings.
+    """
+    if not sentences:
+        return []
+    token_counts = sentence_token_counts(sentences)
+    prefix = list(accumulate(token_counts, initial=0))
+    return [
+        {
             "source": source_file,
-            "start_token": start_token,
-            "end_token": end_token,
-            "embedding": embedding,
+            "doc_id": chunk_doc_id(source_file, chunk_id),
+            "content_hash": content_hash,
+            "story_title": title,
+            "text": " ".join(sentences[start:end]),
+            "chunk_id": chunk_id,
+            "start_token": prefix[start],
+            "end_token": prefix[end],
         }
-        chunks.append(result)
-        # Slide window for overlap
-        if OVERLAP:
-            overlap_sents = current_chunk[-OVERLAP:]
-            start_token = end_token - sum(count_tokens(s) for s in overlap_sents)
-            current_chunk[:] = overlap_sents
-            return sum(count_tokens(s) for s in current_chunk)
-        else:
-            current_chunk.clear()
-            start_token = end_token
-            return 0
+        for chunk_id, (start, end) in enumerate(
+            chunk_windows(token_counts, MAX_TOKENS, OVERLAP, OVERLAP_UNIT)
+        )
+    ]
+
+
+def embed_chunks(chunks: List[Dict], batch_size: int):
+    embeddings = encoder.encode(
+        [c["text"] for c in chunks], batch_size=batch_size, normalize_embeddings=True
+    )
+    # Kept as arrays, the CorpusWriter turns them into whatever the corpus format needs.
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk["embedding"] = embedding
 
-    for sent in doc.sents:
-        sent_text = sent.text.strip()
-        sent_tokens = count_tokens(sent_text)
 
-        if current_tokens + sent_tokens > MAX_TOKENS and current_chunk:
-            current_tokens = chunk_text()
+def iter_stories(file_paths: List[Path]):
+    for file_path in file_paths:
+        story = read_story(file_path)
+        if story is None:
+            continue
+        story_text, story_title = story
+        yield story_text, (story_title, file_path.name)
 
-        current_chunk.append(sent_text)
-        current_tokens += sent_tokens
 
-    # Final chunk
-    if current_chunk:
-        chunk_text()
+def chunking_params() -> dict:
+    # Anything that changes the chunk records. If one of these changes, every story has to be redone.
+    return {
+        "manifest_version": MANIFEST_VERSION,
+        "embedding_model": MODEL,
+        "spacy_model": SPACY_MODEL,
+        "max_tokens": MAX_TOKENS,
+        "overlap": OVERLAP,
+        "overlap_unit": OVERLAP_UNIT,
+    }
 
-    return chunks
+
+def copy_unchanged(writer: CorpusWriter, keep_sources: set[str]) -> int:
+    """
+    Carry over the already embedded chunks of stories that haven't changed since the last run. Between two jsonl
+    corpora the lines are copied verbatim. Anything involving the npy layout goes through the readers and writers,
+    which also takes care of switching CORPUS_FORMAT without re-embedding anything.
+    """
+    copied = 0
+    if writer.compact or is_compact(OUTPUT_FILE):
+        for doc, _ in iter_corpus(OUTPUT_FILE, keep_sources):
+            writer.write(doc)
+            copied += 1
+        return copied
+    with open(OUTPUT_FILE, "r", encoding="utf-8") as in_f:
+        for line in in_f:
+            if line.strip() and record_source(line) in keep_sources:
+                writer.write_line(line)
+                copied += 1
+    return copied
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Split the raw corpus into overlapping chunks and embed them."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="spaCy processes used for sentence splitting.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="Chunks per encoder forward pass.",
+    )
+    parser.add_argument(
+        "--flush-every",
+        type=int,
+        default=2048,
+        help="Embed and write out chunks once this many are buffered. Bounds memory on big corpora.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the manifest and re-chunk and re-embed every story.",
+    )
+    args = parser.parse_args()
+    if OVERLAP_UNIT not in ("tokens", "sentences"):
+        raise ValueError(
+            f"CHUNK_OVERLAP_UNIT must be 'tokens' or 'sentences', not '{OVERLAP_UNIT}'"
+        )
+
     input_path = Path(INPUT_FILE_DIR)
+    file_paths = sorted(input_path.glob("*.txt"))
+
+    # Work out which stories actually need work. The manifest records a content hash per story along with the
+    # parameters the chunks were made with, so an unchanged story can keep its chunks and embeddings as they are.
+    manifest_file = manifest_path(OUTPUT_FILE)
+    params = chunking_params()
+    story_hashes = {p.name: file_hash(p) for p in file_paths}
+    old_manifest = load_manifest(manifest_file)
+    incremental = (
+        not args.full
+        and old_manifest is not None
+        and old_manifest.get("params") == params
+        and Path(OUTPUT_FILE).exists()
+    )
+    old_stories = old_manifest["stories"] if incremental else {}
+    unchanged = {
+        name
+        for name, content_hash in story_hashes.items()
+        if old_stories.get(name, {}).get("hash") == content_hash
+    }
+    to_process = [p for p in file_paths if p.name not in unchanged]
+    removed = set(old_stories) - set(story_hashes)
+    print(
+        f"{len(file_paths)} stories: {len(unchanged)} unchanged, {len(to_process)} to process, "
+        f"{len(removed)} removed{'' if incremental else ' (full rebuild)'}"
+    )
+    # The layout isn't part of params since switching it doesn't need anything re-embedded, but it does need a rewrite.
+    layout = {"format": CORPUS_FORMAT, "dtype": EMBEDDING_DTYPE}
+    if (
+        incremental
+        and not to_process
+        and not removed
+        and old_manifest.get("layout", {"format": "jsonl", "dtype": "float32"})
+        == layout
+    ):
+        print(f"{OUTPUT_FILE} is already up to date.")
+        return
+
+    stories = {name: old_stories[name] for name in unchanged}
+    for file_path in to_process:
+        stories[file_path.name] = {"hash": story_hashes[file_path.name], "chunks": 0}
+
+    total_chunks = 0
+    total_tokens = 0
+    start = time.perf_counter()
+    buffer: List[Dict] = []
+
+    def flush():
+        nonlocal total_chunks, total_tokens
+        if not buffer:
+            return
+        embed_chunks(buffer, args.batch_size)
+        for chunk in buffer:
+            writer.write(chunk)
+        total_chunks += len(buffer)
+        total_tokens += sum(c["end_token"] - c["start_token"] for c in buffer)
+        buffer.clear()
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as out_f:
-        for file_path in tqdm(
-            list(input_path.glob("*.txt")), desc="Processing stories"
-        ):
-            with open(file_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                if not lines:
-                    assert f"There are no lines in the file: {file_path.name}"
-                title_line = lines[0].strip()
-                story_text = "".join(lines[1:]).strip()
-                story_title = extract_title(title_line)
-
-                story_chunks = chunk_and_embed_story(
-                    story_text, story_title, file_path.name
+    # Everything goes to temp files that replace the corpus at the end, so an interrupted run leaves the old corpus
+    # and manifest consistent with each other.
+    writer = CorpusWriter(OUTPUT_FILE, CORPUS_FORMAT, EMBEDDING_DTYPE)
+    try:
+        if unchanged:
+            copied = copy_unchanged(writer, unchanged)
+            print(f"Kept {copied} chunks from {len(unchanged)} unchanged stories")
+        if to_process:
+            load_models()
+            docs = nlp.pipe(
+                iter_stories(to_process),
+                as_tuples=True,
+                n_process=args.workers,
+                batch_size=4,
+            )
+            for doc, (story_title, source_file) in tqdm(
+                docs, total=len(to_process), desc="Processing stories"
+            ):
+                sentences = [s.text.strip() for s in doc.sents if s.text.strip()]
+                story_chunks = chunk_story(
+                    sentences,
+                    story_title,
+                    source_file,
+                    stories[source_file]["hash"],
                 )
-                for chunk in story_chunks:
-                    out_f.write(json.dumps(chunk) + "\n")
+                stories[source_file].update(title=story_title, chunks=len(story_chunks))
+                buffer.extend(story_chunks)
+                if len(buffer) >= args.flush_every:
+                    flush()
+            flush()
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    save_manifest(
+        manifest_file, {"params": params, "layout": layout, "stories": stories}
+    )
 
+    elapsed = time.perf_counter() - start
     logger.info(f"Finished writing chunks to {OUTPUT_FILE}")
+    print(
+        f"Wrote {total_chunks} new chunks ({total_tokens} tokens) in {elapsed:.1f}s: "
+        f"{total_chunks / elapsed:.1f} chunks/s, {total_tokens / elapsed:.0f} tokens/s"
+    )
 
 
 if __name__ == "__main__":
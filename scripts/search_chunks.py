@@ -1,3 +1,4 @@
+import argparse
 import os
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch
@@ -26,6 +27,10 @@ ES_INDEX = os.getenv("ES_INDEX")
 ES_USER = os.getenv("ES_USER")
 ES_PASS = os.getenv("ES_PASSWORD")
 MODEL_NAME = "BAAI/bge-base-en-v1.5"
+SEARCH_MODES = ("knn", "exact")
+SEARCH_MODE = os.getenv("ES_SEARCH_MODE", "knn").lower()
+KNN_K = int(os.getenv("ES_KNN_K", "10"))
+KNN_NUM_CANDIDATES = int(os.getenv("ES_KNN_NUM_CANDIDATES", "100"))
 
 
 # Connect to Elasticsearch
@@ -41,13 +46,12 @@ def embed_query(query: str):
     return encoder.encode(query, normalize_embeddings=True).tolist()
 
 
-def search(query: str, top_k=5):
-    print(f"\n🔍 Searching for: {query}")
-    embedding = embed_query(query)
-
-    body = {
-        "size": top_k,
-        "query": {
+def build_query(embedding, top_k: int, mode: str) -> dict:
+    # Same request shapes the API's ESSearch uses. "exact" scores every chunk with script_score, "knn" walks the
+    # HNSW graph and only looks at num_candidates chunks per shard.
+    body = {"size": top_k, "_source": {"excludes": ["embedding"]}}
+    if mode == "exact":
+        body["query"] = {
             "script_score": {
                 "query": {"match_all": {}},
                 "script": {
@@ -55,8 +59,22 @@ def search(query: str, top_k=5):
                     "params": {"query_vector": embedding},
                 },
             }
-        },
-    }
+        }
+    else:
+        k = max(KNN_K, top_k)
+        body["knn"] = {
+            "field": "embedding",
+            "query_vector": embedding,
+            "k": k,
+            "num_candidates": max(KNN_NUM_CANDIDATES, k),
+        }
+    return body
+
+
+def search(query: str, top_k=5, mode=SEARCH_MODE):
+    print(f"\n🔍 Searching for ({mode}): {query}")
+    embedding = embed_query(query)
+    body = build_query(embedding, top_k, mode)
 
     res = es.search(index=ES_INDEX, body=body)
 
@@ -68,6 +86,21 @@ def search(query: str, top_k=5):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the chunk index directly.")
+    parser.add_argument(
+        "--mode",
+        choices=SEARCH_MODES,
+        help="Approximate kNN or exact script_score, handy for eyeballing recall. Defaults to ES_SEARCH_MODE.",
+    )
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+    if args.mode is None:
+        # ES_SEARCH_MODE can also be "hybrid", which this script doesn't do. Say so rather than quietly running knn.
+        args.mode = SEARCH_MODE if SEARCH_MODE in SEARCH_MODES else "knn"
+        if args.mode != SEARCH_MODE:
+            print(
+                f"ES_SEARCH_MODE={SEARCH_MODE} isn't supported here, searching with {args.mode} instead."
+            )
     print(
         "Ask the DB for chunks directly to see the raw outputs most close to your query."
     )
@@ -76,6 +109,6 @@ if __name__ == "__main__":
             query = input("\nAsk the Eldrich Oracle (or 'exit'): ").strip()
             if query.lower() in ("exit", "quit"):
                 break
-            search(query)
+            search(query, top_k=args.top_k, mode=args.mode)
         except KeyboardInterrupt:
             break
@@ -1,12 +1,30 @@
-from elasticsearch import Elasticsearch
+import argparse
+import hashlib
+import logging
 import os
+import ssl
 import sys
+import time
+import warnings
+from collections import defaultdict
 from pathlib import Path
+
 from dotenv import load_dotenv
-import ssl
-import warnings
+from elasticsearch import Elasticsearch
 from urllib3.exceptions import InsecureRequestWarning
-import logging
+
+from corpus_io import count_records, iter_corpus
+
+# Checks that the index holds exactly the chunks of the corpus, and says which ones are off when it doesn't.
+#
+# Both sides are streamed: the corpus a line at a time, the index through a point in time scan sorted by story and
+# chunk. Each story is boiled down to a chunk count and a checksum of its chunks' content. Memory is therefore bounded
+# by the number of stories (a few hundred small summaries), not constant, but it never grows with the number of chunks
+# or the size of the embeddings. Only the stories whose summaries disagree are then looked at chunk by chunk to report
+# missing, extra, changed and duplicate chunks, which needs memory for the chunks of at most --max-detail-stories
+# stories.
+#
+# Exit codes (the Makefile relies on them): 0 all good, 2 no index, 3 empty index, 4 the index doesn't match.
 
 logger = logging.getLogger(__name__)
 
@@ -33,35 +51,259 @@ es = Elasticsearch(
     ssl_context=context,
 )
 
-# Check if index exists
-if not es.indices.exists(index=ES_INDEX):
-    logger.info(f"Index '{ES_INDEX}' does not exist.")
-    sys.exit(2)
-
-logger.info(f"Index '{ES_INDEX}' exists.")
-
-# Count documents
-try:
-    with open(CORPUS_JSONL_FILE, "r") as file:
-        lines = file.readlines()
-        num_lines = len(lines)
-        logger.info(f"The file has {num_lines} lines.")
-        count = es.count(index=ES_INDEX)["count"]
-        if count == 0:
-            logger.error(
-                f"Index '{ES_INDEX}' exists but contains 0 documents. You need to run the index command."
-            )
-            sys.exit(3)
-        elif count == num_lines:
-            logger.error(
-                f"Index and jsonl file contain {count} entries. Looks like everything is indexed!"
+NO_SOURCE = "(no source)"
+_CHECKSUM_MOD = 1 << 64
+
+
+def chunk_checksum(chunk_id: int, text: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(f"{chunk_id}\0{text}".encode("utf-8"), digest_size=8).digest()
+    )
+
+
+class Progress:
+    """
+    Logs how far a pass has got every few seconds, so a long verification doesn't look like it hung.
+    """
+
+    def __init__(self, label: str, total: int, every_seconds: float = 5):
+        self.label = label
+        self.total = total
+        self.every = every_seconds
+        self.done = 0
+        self.start = self._last = time.perf_counter()
+
+    def update(self, n: int = 1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.every:
+            self._last = now
+            self._log(now)
+
+    def finish(self):
+        self._log(time.perf_counter())
+
+    def _log(self, now: float):
+        elapsed = now - self.start
+        percent = f" ({self.done / self.total:.0%})" if self.total else ""
+        logger.info(
+            f"{self.label}: {self.done}/{self.total} chunks{percent}, {self.done / max(elapsed, 1e-9):.0f}/s"
+        )
+
+
+def scan_index(page_size: int, sources: list[str] | None = None):
+    """
+    Stream (source, chunk_id, text) for every chunk in the index, or only those of the given stories, in story then
+    chunk order. A point in time keeps the view consistent while we page through it with search_after, and unlike
+    from/size paging it works at any depth.
+    """
+    pit = es.open_point_in_time(index=ES_INDEX, keep_alive="2m")["id"]
+    query = {"terms": {"source": sources}} if sources is not None else None
+    after = None
+    try:
+        while True:
+            res = es.search(
+                pit={"id": pit, "keep_alive": "2m"},
+                size=page_size,
+                query=query,
+                source=["source", "chunk_id", "text"],
+                # The PIT adds _shard_doc as the final tiebreaker, so duplicates of a chunk still page correctly.
+                sort=[
+                    {"source": {"order": "asc", "missing": "_last"}},
+                    {"chunk_id": {"order": "asc", "missing": "_last"}},
+                ],
+                search_after=after,
+                track_total_hits=False,
             )
+            pit = res.get("pit_id", pit)
+            hits = res["hits"]["hits"]
+            if not hits:
+                return
+            for hit in hits:
+                doc = hit["_source"]
+                yield (
+                    doc.get("source") or NO_SOURCE,
+                    doc.get("chunk_id"),
+                    doc.get("text", ""),
+                )
+            after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit)
+
+
+def summarize_corpus(total: int) -> dict[str, list[int]]:
+    """
+    One pass over the corpus, keeping one summary per story.
+    :return: story -> [chunk count, content checksum]
+    """
+    summaries = defaultdict(lambda: [0, 0])
+    progress = Progress("Corpus", total)
+    for doc, _ in iter_corpus(CORPUS_JSONL_FILE):
+        summary = summaries[doc["source"]]
+        summary[0] += 1
+        summary[1] = (
+            summary[1] + chunk_checksum(doc["chunk_id"], doc["text"])
+        ) % _CHECKSUM_MOD
+        progress.update()
+    progress.finish()
+    return dict(summaries)
+
+
+def summarize_index(total: int, page_size: int) -> dict[str, list[int]]:
+    """
+    :return: story -> [chunk count, content checksum, duplicate chunks]. The scan is sorted by story and chunk, so
+        copies of a chunk come one after the other and spotting them takes no extra memory.
+    """
+    summaries = defaultdict(lambda: [0, 0, 0])
+    progress = Progress("Index", total)
+    previous = None
+    for source, chunk_id, text in scan_index(page_size):
+        summary = summaries[source]
+        summary[0] += 1
+        summary[1] = (summary[1] + chunk_checksum(chunk_id, text)) % _CHECKSUM_MOD
+        if (source, chunk_id) == previous:
+            summary[2] += 1
+        previous = (source, chunk_id)
+        progress.update()
+    progress.finish()
+    return dict(summaries)
+
+
+def chunk_details(
+    sources: list[str], page_size: int
+) -> tuple[dict[tuple, list[int]], dict[tuple, list[int]]]:
+    """
+    Checksums of every chunk of the given stories on both sides, for the stories whose summaries disagree.
+    :return: (corpus, index), each (source, chunk_id) -> checksums of its copies
+    """
+    corpus = defaultdict(list)
+    for doc, _ in iter_corpus(CORPUS_JSONL_FILE, set(sources)):
+        corpus[(doc["source"], doc["chunk_id"])].append(
+            chunk_checksum(doc["chunk_id"], doc["text"])
+        )
+    index = defaultdict(list)
+    for source, chunk_id, text in scan_index(page_size, sources):
+        index[(source, chunk_id)].append(chunk_checksum(chunk_id, text))
+    return corpus, index
+
+
+def _format_chunks(keys: list[tuple], show: int) -> str:
+    listed = ", ".join(f"{source}#{chunk_id}" for source, chunk_id in keys[:show])
+    more = f" and {len(keys) - show} more" if len(keys) > show else ""
+    return listed + more
+
+
+def report_details(sources: list[str], page_size: int, show: int):
+    corpus, index = chunk_details(sources, page_size)
+    problems = {
+        "missing from the index": sorted(corpus.keys() - index.keys()),
+        "in the index but not the corpus": sorted(index.keys() - corpus.keys()),
+        "with different content": sorted(
+            key
+            for key in corpus.keys() & index.keys()
+            if set(corpus[key]) != set(index[key])
+        ),
+        "duplicated in the index": sorted(
+            key for key, copies in index.items() if len(copies) > 1
+        ),
+        "duplicated in the corpus": sorted(
+            key for key, copies in corpus.items() if len(copies) > 1
+        ),
+    }
+    for problem, keys in problems.items():
+        if keys:
+            logger.error(f"{len(keys)} chunks {problem}: {_format_chunks(keys, show)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Verify that the ES index holds exactly the chunks in the corpus."
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=1000, help="Chunks per page of the index scan."
+    )
+    parser.add_argument(
+        "--max-detail-stories",
+        type=int,
+        default=20,
+        help="Mismatched stories to compare chunk by chunk. The rest only get their counts reported.",
+    )
+    parser.add_argument(
+        "--show", type=int, default=10, help="Chunks to list per kind of problem."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not es.indices.exists(index=ES_INDEX):
+        logger.info(f"Index '{ES_INDEX}' does not exist.")
+        sys.exit(2)
+    logger.info(f"Index '{ES_INDEX}' exists.")
+
+    count = es.count(index=ES_INDEX)["count"]
+    if count == 0:
+        logger.error(
+            f"Index '{ES_INDEX}' exists but contains 0 documents. You need to run the index command."
+        )
+        sys.exit(3)
+
+    try:
+        # Streams the file (jsonl or npy corpus) rather than reading it all into memory.
+        num_records = count_records(CORPUS_JSONL_FILE)
+        logger.info(
+            f"The corpus has {num_records} records and the index {count} documents."
+        )
+        corpus = summarize_corpus(num_records)
+        index = summarize_index(count, args.page_size)
+    except Exception as e:
+        logger.error(f"Error reading the corpus or index:\n{type(e).__name__}: {e}")
+        sys.exit(4)
+
+    mismatched = []
+    for source in sorted(corpus.keys() | index.keys()):
+        expected_chunks, expected_checksum = corpus.get(source, (0, 0))
+        chunks, checksum, duplicates = index.get(source, (0, 0, 0))
+        if (expected_chunks, expected_checksum) == (
+            chunks,
+            checksum,
+        ) and not duplicates:
+            continue
+        mismatched.append(source)
+        if source not in index:
+            detail = "missing from the index"
+        elif source not in corpus:
+            detail = "not in the corpus"
+        elif expected_chunks != chunks or duplicates:
+            detail = f"{chunks} chunks indexed, {expected_chunks} in the corpus"
         else:
-            logger.error(
-                f"Index contains {count} documents and we expected {num_lines} from the corpus jsonl file. You should "
-                f"reindex or just know you might not get expected results."
-            )
-            sys.exit(4)
-except Exception as e:
-    logger.error(f"Error counting documents:\n{type(e).__name__}: {e}")
+            detail = "content differs"
+        if duplicates:
+            detail += f", {duplicates} of them duplicates"
+        logger.error(f"Story '{source}': {detail}")
+
+    if not mismatched:
+        logger.info(
+            f"Index and corpus agree on all {num_records} chunks of {len(corpus)} stories. Looks like everything is indexed!"
+        )
+        return
+
+    logger.error(
+        f"{len(mismatched)} of {len(corpus.keys() | index.keys())} stories don't match. You should reindex or just "
+        f"know you might not get expected results."
+    )
+    # Chunks without a source can't be looked up by story, their summary line is all we can say about them.
+    detail_sources = [s for s in mismatched if s != NO_SOURCE][
+        : args.max_detail_stories
+    ]
+    if len(mismatched) > len(detail_sources):
+        logger.info(
+            f"Comparing the first {len(detail_sources)} of them chunk by chunk..."
+        )
+    try:
+        report_details(detail_sources, args.page_size, args.show)
+    except Exception as e:
+        logger.error(f"Error comparing chunks:\n{type(e).__name__}: {e}")
     sys.exit(4)
+
+
+if __name__ == "__main__":
+    main()
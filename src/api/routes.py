@@ -1,7 +1,29 @@
+import asyncio
+import json
+import logging
+from contextlib import aclosing
+
 from fastapi import APIRouter, Depends, Request, HTTPException
-from models.chat import ChatRequest, ChatMessage
+from fastapi.responses import StreamingResponse
+from core.metrics import request_timings
+from models.chat import (
+    ChatBatchItem,
+    ChatBatchRequest,
+    ChatBatchResponse,
+    ChatRequest,
+    ChatMessage,
+)
+from models.search import (
+    BatchError,
+    SearchBatchItem,
+    SearchBatchRequest,
+    SearchBatchResponse,
+)
+from core.resilience import CircuitOpen
+from services.admission import Overloaded, deadline_after
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 def get_agent(request: Request):
@@ -11,9 +33,168 @@ def get_agent(request: Request):
     return agent
 
 
+def _http_error(e: Exception) -> HTTPException:
+    if isinstance(e, (Overloaded, CircuitOpen)):
+        return HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return HTTPException(status_code=504, detail="Request deadline exceeded")
+
+
 @router.post("/chat", response_model=ChatMessage)
 async def chat(request: ChatRequest, agent=Depends(get_agent)):
-    return agent.generate_response(request)
+    deadline = deadline_after(agent.config.request_timeout_seconds)
+    try:
+        return await agent.generate_response(request, deadline=deadline)
+    except (Overloaded, CircuitOpen, TimeoutError) as e:
+        raise _http_error(e)
+
+
+def _batch_error(e: Exception) -> BatchError:
+    if isinstance(e, (Overloaded, CircuitOpen, TimeoutError)):
+        http_error = _http_error(e)
+        return BatchError(
+            status_code=http_error.status_code,
+            detail=http_error.detail,
+            retry_after=getattr(e, "retry_after", None),
+        )
+    if isinstance(e, ValueError):
+        return BatchError(status_code=422, detail=str(e))
+    # Anything else is the search backend or the inference server letting us down
+    return BatchError(status_code=502, detail=f"{type(e).__name__}: {e}")
+
+
+def _check_batch_size(size: int, agent):
+    if size > agent.config.batch_max_items:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {size} is over the limit of {agent.config.batch_max_items}",
+        )
+
+
+@router.post("/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch(request: ChatBatchRequest, agent=Depends(get_agent)):
+    """
+    Answer many independent questions in one call. The results come back in the order of the requests, each with
+    either a message or an error, so one failed item doesn't sink the batch.
+    """
+    _check_batch_size(len(request.requests), agent)
+    deadline = deadline_after(agent.config.batch_timeout_seconds)
+    try:
+        results = await agent.generate_batch(request.requests, deadline=deadline)
+    except TimeoutError as e:
+        raise _http_error(e)
+    return ChatBatchResponse(
+        results=[
+            ChatBatchItem(error=_batch_error(r))
+            if isinstance(r, Exception)
+            else ChatBatchItem(message=r)
+            for r in results
+        ]
+    )
+
+
+@router.post("/search/batch", response_model=SearchBatchResponse)
+async def search_batch(request: SearchBatchRequest, agent=Depends(get_agent)):
+    """
+    Retrieval only: the hits for each query, in order, with no LLM involved. All the queries are embedded in one encode
+    call and searched in one round trip.
+    """
+    _check_batch_size(len(request.queries), agent)
+    search = agent.search_service
+    try:
+        async with asyncio.timeout_at(
+            deadline_after(agent.config.batch_timeout_seconds)
+        ):
+            vectors = await search.embed_queries(request.queries)
+            results = await search.search_many(
+                request.queries, top_k=request.top_k, query_vectors=vectors
+            )
+    except TimeoutError as e:
+        raise _http_error(e)
+    except Exception as e:
+        # The shared embed or search round trip failed (ES down, breaker open...). Every query gets the error it would
+        # have had on its own, same as the items of a chat batch.
+        logger.warning(f"Batch search failed: {type(e).__name__}: {e}")
+        results = [e] * len(request.queries)
+    return SearchBatchResponse(
+        results=[
+            SearchBatchItem(error=_batch_error(r))
+            if isinstance(r, Exception)
+            else SearchBatchItem(hits=r)
+            for r in results
+        ]
+    )
+
+
+def _sse(data: dict, event: str | None = None) -> str:
+    # Tokens can contain newlines which would end an SSE event early, so every payload goes out as JSON.
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest, http_request: Request, agent=Depends(get_agent)
+):
+    """
+    Stream the assistant reply as Server-Sent Events. Each token arrives as a default "message" event with a
+    {"token": ...} payload, followed by a final "done" event (or an "error" event if generation fails part way). With
+    SERVER_TIMING_HEADER on, the "done" event carries the per stage timings.
+
+    The response only starts once the first token is there, so a request that's shed or runs out of time before then
+    still gets a plain 429/503/504 its client (or load balancer) knows to retry, rather than an error inside a 200.
+    """
+    deadline = deadline_after(agent.config.request_timeout_seconds)
+    tokens = agent.stream_response(request, deadline=deadline)
+    first, failure = [], None
+    try:
+        first.append(await anext(tokens))
+    except StopAsyncIteration:
+        pass
+    except (Overloaded, CircuitOpen, TimeoutError) as e:
+        await tokens.aclose()
+        raise _http_error(e)
+    except Exception as e:
+        failure = e
+
+    async def event_stream():
+        # aclosing makes sure the agent's generator is closed (and with it the upstream completion) whether we
+        # finish, bail out on a disconnect, or get cancelled by the server.
+        async with aclosing(tokens):
+            try:
+                if failure is not None:
+                    raise failure
+                for token in first:
+                    yield _sse({"token": token})
+                async for token in tokens:
+                    if await http_request.is_disconnected():
+                        logger.info("Client disconnected, cancelling generation")
+                        return
+                    yield _sse({"token": token})
+            except TimeoutError:
+                yield _sse({"detail": "Request deadline exceeded"}, event="error")
+                return
+            except Exception as e:
+                logger.exception("Streaming chat failed")
+                yield _sse({"detail": f"{type(e).__name__}: {e}"}, event="error")
+                return
+        done = {}
+        # Headers went out with the first token, so the full LLM timings can only come at the end.
+        if getattr(http_request.state, "server_timing", False):
+            done["timings_ms"] = {
+                stage: round(seconds * 1000, 1)
+                for stage, seconds in request_timings().items()
+            }
+        yield _sse(done, event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # def router(agent: RAGAgent) -> APIRouter:
@@ -3,11 +3,11 @@ import os
 import logging
 from pathlib import Path
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
 import ssl
-from openai import OpenAI
 from pythonjsonlogger.json import JsonFormatter
 
+from core.resilience import CircuitBreaker, RetryPolicy
+
 
 class Config:
     def __init__(self):
@@ -23,50 +23,230 @@ class Config:
         self.es_user = os.getenv("ES_USER")
         self.es_password = os.getenv("ES_PASSWORD")
         self.es_index = os.getenv("ES_INDEX")
-        self.top_k_search_results = os.getenv("TOP_K_ES_RESULTS")
+        self.top_k_search_results = int(os.getenv("TOP_K_ES_RESULTS", "1"))
+        # The retrieved chunks are packed into the system prompt up to this many tokens, counted with
+        # CONTEXT_TOKENIZER. Ideally that's the Hugging Face name of the LLM's own tokenizer. It falls back to the
+        # embedding model's tokenizer, which is close enough for budgeting.
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+        self.context_tokenizer = os.getenv("CONTEXT_TOKENIZER") or os.getenv(
+            "EMBEDDING_MODEL"
+        )
+        # "knn" uses the HNSW graph on the embedding field, "exact" brute-forces cosine similarity over every chunk
+        # with script_score. Exact is only really useful for checking recall against the approximate search.
+        self.es_search_mode = os.getenv("ES_SEARCH_MODE", "knn").lower()
+        self.es_knn_k = int(os.getenv("ES_KNN_K", "10"))
+        self.es_knn_num_candidates = int(os.getenv("ES_KNN_NUM_CANDIDATES", "100"))
+        # "hybrid" runs a BM25 match on the chunk text and a kNN query in one _msearch round trip, then fuses the two
+        # rankings with weighted reciprocal rank fusion. Each list contributes weight / (rank_constant + rank).
+        self.es_hybrid_candidates = int(os.getenv("ES_HYBRID_CANDIDATES", "20"))
+        self.es_hybrid_bm25_weight = float(os.getenv("ES_HYBRID_BM25_WEIGHT", "1.0"))
+        self.es_hybrid_knn_weight = float(os.getenv("ES_HYBRID_KNN_WEIGHT", "1.0"))
+        self.es_hybrid_rank_constant = int(os.getenv("ES_HYBRID_RANK_CONSTANT", "60"))
+
+        # "elasticsearch" or "local". The local backend searches a memory-mapped copy of the corpus embeddings in
+        # process, which is plenty for a corpus the size of the Lovecraft set and needs no ES cluster at all.
+        self.search_backend = os.getenv("SEARCH_BACKEND", "elasticsearch").lower()
+        self.corpus_jsonl_file = os.getenv("CORPUS_JSONL_FILE")
+        self.local_index_dir = os.getenv("LOCAL_INDEX_DIR", "local_index")
 
         self.embedding_model = os.getenv("EMBEDDING_MODEL")
+        # Concurrent query embeddings are grouped into one encode call. A batch is flushed when it hits the size limit
+        # or when the oldest query has waited this many milliseconds.
+        self.embed_batch_max_size = int(os.getenv("EMBED_BATCH_MAX_SIZE", "32"))
+        self.embed_batch_max_wait_ms = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5"))
+        # Repeated questions skip the encoder entirely. Size 0 turns the cache off, TTL 0 means entries only leave
+        # through LRU eviction, and setting a path persists the cache to a SQLite file across restarts.
+        self.embed_cache_size = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+        self.embed_cache_ttl_seconds = float(os.getenv("EMBED_CACHE_TTL_SECONDS", "0"))
+        self.embed_cache_path = os.getenv("EMBED_CACHE_PATH") or None
+        # Finished answers are reused for new questions whose embedding is at least this similar to one we've already
+        # answered. Size 0 turns the answer cache off.
+        self.answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+        self.answer_cache_ttl_seconds = float(
+            os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600")
+        )
+        self.answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+        # Retrieved chunks are remembered per conversation_id. A follow-up at least SESSION_REUSE_THRESHOLD similar to
+        # the last question we searched for reuses them without searching, one at least SESSION_EXTEND_THRESHOLD similar
+        # searches and adds to them, anything less starts over. Size 0 turns this off.
+        self.session_store_size = int(os.getenv("SESSION_STORE_SIZE", "1024"))
+        self.session_ttl_seconds = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+        self.session_reuse_threshold = float(
+            os.getenv("SESSION_REUSE_THRESHOLD", "0.9")
+        )
+        self.session_extend_threshold = float(
+            os.getenv("SESSION_EXTEND_THRESHOLD", "0.75")
+        )
+        self.session_max_hits = int(os.getenv("SESSION_MAX_HITS", "20"))
+
+        # At most LLM_MAX_CONCURRENCY completions are sent to the inference server at once (0 for no limit), with up to
+        # LLM_MAX_QUEUE more waiting for a slot. Requests past that get a 429, and ones that waited longer than
+        # LLM_QUEUE_TIMEOUT_SECONDS a 503, both with a Retry-After. Every chat request has REQUEST_TIMEOUT_SECONDS from
+        # arrival to finish, search and generation included, or it's cancelled with a 504 (0 for no deadline).
+        self.llm_max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+        self.llm_max_queue = int(os.getenv("LLM_MAX_QUEUE", "32"))
+        self.llm_queue_timeout_seconds = float(
+            os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10")
+        )
+        self.request_timeout_seconds = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "60"))
+
+        # /api/chat/batch and /api/search/batch take up to BATCH_MAX_ITEMS questions, embedded in one encode call and
+        # searched in one round trip. BATCH_LLM_CONCURRENCY caps how many of a chat batch's completions run at once
+        # (they still go through the LLM admission control above) and the whole batch has BATCH_TIMEOUT_SECONDS.
+        self.batch_max_items = int(os.getenv("BATCH_MAX_ITEMS", "64"))
+        self.batch_llm_concurrency = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+        self.batch_timeout_seconds = float(os.getenv("BATCH_TIMEOUT_SECONDS", "300"))
+
+        # Client tuning. ES gets a connection pool of ES_CONNECTIONS_PER_NODE and gives up on a request after
+        # ES_REQUEST_TIMEOUT_SECONDS. The inference client keeps up to LLM_POOL_MAX_CONNECTIONS open (keep it at or
+        # above LLM_MAX_CONCURRENCY plus some for batches), LLM_POOL_KEEPALIVE_CONNECTIONS of them idle for up to
+        # LLM_KEEPALIVE_EXPIRY_SECONDS. LLM_READ_TIMEOUT_SECONDS is the longest gap between bytes, which for a regular
+        # completion includes generating the whole answer.
+        self.es_request_timeout_seconds = float(
+            os.getenv("ES_REQUEST_TIMEOUT_SECONDS", "10")
+        )
+        self.es_connections_per_node = int(os.getenv("ES_CONNECTIONS_PER_NODE", "10"))
+        self.llm_connect_timeout_seconds = float(
+            os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5")
+        )
+        self.llm_read_timeout_seconds = float(
+            os.getenv("LLM_READ_TIMEOUT_SECONDS", "120")
+        )
+        self.llm_pool_max_connections = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "32"))
+        self.llm_pool_keepalive_connections = int(
+            os.getenv("LLM_POOL_KEEPALIVE_CONNECTIONS", "16")
+        )
+        self.llm_keepalive_expiry_seconds = float(
+            os.getenv("LLM_KEEPALIVE_EXPIRY_SECONDS", "30")
+        )
+        # Connection errors, timeouts and 5xx/429 answers are retried up to *_MAX_RETRIES times with jittered
+        # exponential backoff. After *_BREAKER_FAILURES of them in a row the dependency's circuit breaker opens and
+        # calls fail fast for *_BREAKER_RESET_SECONDS before one is let through to test the water. With
+        # DEGRADED_ANSWERS, chat requests the LLM can't serve get the retrieved passages instead of an error.
+        self.es_max_retries = int(os.getenv("ES_MAX_RETRIES", "2"))
+        self.llm_max_retries = int(os.getenv("LLM_MAX_RETRIES", "2"))
+        self.retry_base_delay_seconds = float(
+            os.getenv("RETRY_BASE_DELAY_SECONDS", "0.1")
+        )
+        self.retry_max_delay_seconds = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "2"))
+        self.es_breaker_failures = int(os.getenv("ES_BREAKER_FAILURES", "5"))
+        self.es_breaker_reset_seconds = float(
+            os.getenv("ES_BREAKER_RESET_SECONDS", "30")
+        )
+        self.llm_breaker_failures = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+        self.llm_breaker_reset_seconds = float(
+            os.getenv("LLM_BREAKER_RESET_SECONDS", "30")
+        )
+        self.degraded_answers = os.getenv("DEGRADED_ANSWERS", "true").lower() == "true"
+
+        # Startup warm-up, see main.py. The encoder, tokenizer and clients are loaded and ES is checked before
+        # /health/ready reports ready. Pinging the inference server too is optional since it may well be scaled to zero
+        # or shared, and we'd rather serve retrieval than stay unready because of it. Failed checks are retried.
+        self.warmup_ping_llm = os.getenv("WARMUP_PING_LLM", "false").lower() == "true"
+        self.warmup_retry_seconds = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
 
         # Initialize clients
         self._es_client = None
         self._openai_client = None
+        # One breaker and retry policy per dependency, shared by everything that calls it
+        self.es_breaker = CircuitBreaker(
+            "elasticsearch", self.es_breaker_failures, self.es_breaker_reset_seconds
+        )
+        self.llm_breaker = CircuitBreaker(
+            "llm", self.llm_breaker_failures, self.llm_breaker_reset_seconds
+        )
+        self.es_retry = RetryPolicy(
+            self.es_max_retries,
+            self.retry_base_delay_seconds,
+            self.retry_max_delay_seconds,
+        )
+        self.llm_retry = RetryPolicy(
+            self.llm_max_retries,
+            self.retry_base_delay_seconds,
+            self.retry_max_delay_seconds,
+        )
         self._setup_logging()
 
     @property
     def es_client(self):
         """
-        Initialize the ElasticSearch client. We're ditching security in this simple project, but you should never
-        run like this in the real world.
+        Initialize the async ElasticSearch client. We're ditching security in this simple project, but you should never
+        run like this in the real world. The httpx node class lets us stay async without pulling in aiohttp since
+        httpx already comes along with the OpenAI client.
         :return:
         """
         if self._es_client is None:
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
+            # The client libraries are imported here rather than at the top, so the process is up and answering
+            # /health/live before they've loaded. They account for most of the import time otherwise.
+            from elasticsearch import AsyncElasticsearch
 
-            self._es_client = Elasticsearch(
+            tls = {}
+            # Plain http hosts (like the stand-in ES the benchmarks run against) can't take an SSL context.
+            if self.es_host and self.es_host.startswith("https"):
+                ssl_context = ssl.create_default_context()
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+                tls = {"verify_certs": False, "ssl_context": ssl_context}
+
+            self._es_client = AsyncElasticsearch(
                 self.es_host,
                 basic_auth=(self.es_user, self.es_password),
-                verify_certs=False,
-                ssl_context=ssl_context,
+                node_class="httpxasync",
+                request_timeout=self.es_request_timeout_seconds,
+                connections_per_node=self.es_connections_per_node,
+                # Retries happen in es_retry instead, with backoff and jitter. The client's own go out again straight
+                # away, which with one node just hits the same struggling ES again.
+                max_retries=0,
+                retry_on_timeout=False,
+                **tls,
             )
         return self._es_client
 
     @property
     def openai_client(self):
         """
-        This produces a client that works with any OpenAI compatible API (such as Ollama). You can swap to ChatGPT
+        This produces an async client that works with any OpenAI compatible API (such as Ollama). You can swap to ChatGPT
         if you have an account and enjoy the giant context window. This would let you return more results from ES
         without sacrificing the rest of the system prompt, for example.
         :return:
         """
         if self._openai_client is None:
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
             base_url = self.inference_api_url.rstrip("/") + "/v1"
-            self._openai_client = OpenAI(
-                base_url=base_url, api_key=self.inference_api_key
+            self._openai_client = AsyncOpenAI(
+                base_url=base_url,
+                api_key=self.inference_api_key,
+                timeout=httpx.Timeout(
+                    self.llm_read_timeout_seconds,
+                    connect=self.llm_connect_timeout_seconds,
+                ),
+                # Same as for ES, llm_retry does the retrying.
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=self.llm_pool_max_connections,
+                        max_keepalive_connections=self.llm_pool_keepalive_connections,
+                        keepalive_expiry=self.llm_keepalive_expiry_seconds,
+                    )
+                ),
             )
         return self._openai_client
 
+    async def close(self):
+        """
+        Close whichever clients we actually created so their connection pools shut down cleanly with the app.
+        :return:
+        """
+        if self._es_client is not None:
+            await self._es_client.close()
+            self._es_client = None
+        if self._openai_client is not None:
+            await self._openai_client.close()
+            self._openai_client = None
+
     def _setup_logging(self):
         logger = logging.getLogger()
         if not logger.handlers:
@@ -0,0 +1,308 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+
+# A small Prometheus text format registry. We only need counters and histograms, and this way the whole thing is a
+# page of code rather than another dependency. Everything is updated from the event loop thread, so no locking.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(pairs: list[tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for key, series in sorted(self._series.items()):
+            lines.extend(self._render_series(list(zip(self.labelnames, key)), series))
+        return lines
+
+    def _render_series(self, labels: list[tuple[str, str]], series) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, labels, series) -> list[str]:
+        return [f"{self.name}{_format_labels(labels)} {_format_value(series)}"]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._series[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def _render_series(self, labels, series) -> list[str]:
+        return [f"{self.name}{_format_labels(labels)} {_format_value(series)}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Per bucket counts (not cumulative, that's done when rendering), then sum and count.
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _render_series(self, labels, series) -> list[str]:
+        counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = labels + [("le", _format_value(bound))]
+            lines.append(f"{self.name}_bucket{_format_labels(le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "oracle_http_request_seconds",
+    "Time from request to the end of the response body.",
+    ("route", "method", "status"),
+)
+EMBED_SECONDS = REGISTRY.histogram(
+    "oracle_embed_seconds",
+    "Query embedding time as seen by a request, including the cache lookup and the batching wait.",
+)
+ENCODE_SECONDS = REGISTRY.histogram(
+    "oracle_encode_batch_seconds", "Time the encoder spends on one batch of queries."
+)
+ENCODE_BATCH_SIZE = REGISTRY.histogram(
+    "oracle_encode_batch_size", "Queries per encoder batch.", buckets=BATCH_BUCKETS
+)
+SEARCH_SECONDS = REGISTRY.histogram(
+    "oracle_search_seconds",
+    "Retrieval round trip, from sending the query to having the hits.",
+    ("backend", "mode"),
+)
+ES_TOOK_SECONDS = REGISTRY.histogram(
+    "oracle_es_took_seconds",
+    "Time ES reports spending on the search itself. The gap to oracle_search_seconds is network and client.",
+    ("mode",),
+)
+CONTEXT_SECONDS = REGISTRY.histogram(
+    "oracle_context_assembly_seconds", "Deduplicating and packing hits into the prompt."
+)
+LLM_TTFT_SECONDS = REGISTRY.histogram(
+    "oracle_llm_time_to_first_token_seconds",
+    "Time from sending the completion request to the first streamed token.",
+)
+LLM_SECONDS = REGISTRY.histogram(
+    "oracle_llm_seconds", "Total completion time.", ("stream",)
+)
+LLM_TOKENS = REGISTRY.histogram(
+    "oracle_llm_tokens",
+    "Prompt and completion tokens per LLM call.",
+    ("kind",),
+    buckets=TOKEN_BUCKETS,
+)
+QUEUE_SECONDS = REGISTRY.histogram(
+    "oracle_llm_queue_seconds", "Time spent waiting for an LLM slot."
+)
+REQUESTS_REJECTED = REGISTRY.counter(
+    "oracle_requests_rejected_total",
+    "Requests shed or timed out, by reason (queue_full, queue_timeout, deadline).",
+    ("reason",),
+)
+BREAKER_STATE = REGISTRY.gauge(
+    "oracle_circuit_breaker_state",
+    "Circuit breaker state per dependency: 0 closed, 1 half open, 2 open.",
+    ("dependency",),
+)
+DEPENDENCY_RETRIES = REGISTRY.counter(
+    "oracle_dependency_retries_total",
+    "Calls to a dependency retried after a transient failure.",
+    ("dependency",),
+)
+DEGRADED_ANSWERS = REGISTRY.counter(
+    "oracle_degraded_answers_total",
+    "Chat requests answered with retrieved passages only because the LLM was unavailable.",
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "oracle_cache_lookups_total",
+    "Cache lookups by cache and result.",
+    ("cache", "result"),
+)
+
+
+# == Per request timings ==
+# Stage timers also add their time to a dict held in a context variable for the current request, which is what the
+# Server-Timing header and the streaming "done" event report.
+_request_timings: ContextVar[dict | None] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> dict:
+    timings: dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def request_timings() -> dict:
+    return _request_timings.get() or {}
+
+
+def record_timing(stage: str, seconds: float):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(histogram: Histogram, stage: str | None = None, **labels):
+    """
+    Time the block into a histogram and, if a stage name is given, into the current request's timings.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.observe(elapsed, **labels)
+        if stage:
+            record_timing(stage, elapsed)
+
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (BaseHTTPMiddleware gets in the way of streaming) that gives every request its own timings,
+    records the request duration, and optionally adds a Server-Timing header with the stages that finished before the
+    response started. For a streamed chat that's everything up to the LLM, the rest goes out in the "done" event.
+    """
+
+    def __init__(self, app, server_timing_header: bool = False):
+        self.app = app
+        self.server_timing_header = server_timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = start_request_timings()
+        # Lets handlers see whether timings are reported, as request.state.server_timing.
+        scope.setdefault("state", {})["server_timing"] = self.server_timing_header
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if self.server_timing_header:
+                    elapsed = {**timings, "total": time.perf_counter() - start}
+                    MutableHeaders(scope=message).append(
+                        "Server-Timing", server_timing(elapsed)
+                    )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                # The route template rather than the raw path, so the label can't explode with random URLs.
+                route=getattr(route, "path", "unmatched"),
+                method=scope["method"],
+                status=status["code"],
+            )
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+
+from core.metrics import BREAKER_STATE, DEPENDENCY_RETRIES
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a dependency that's known to be down. The API answers it with a 503 and a Retry-After of
+    however long the breaker stays open.
+    """
+
+    status_code = 503
+
+    def __init__(self, dependency: str, retry_after: int):
+        super().__init__(
+            f"{dependency} is unavailable, not retrying for another {retry_after}s"
+        )
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency that keeps failing, so requests fail in microseconds instead of each one waiting out its
+    own timeouts and piling up behind the others.
+
+    After failure_threshold transient failures in a row the breaker opens and every call raises CircuitOpen. Once
+    reset_timeout_seconds have passed it goes half open and lets a single trial call through. If that works the
+    breaker closes again, if not it's open for another reset_timeout_seconds.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout_seconds: float = 30
+    ):
+        """
+        :param name: The dependency, for errors, logs and the metric label
+        :param failure_threshold: Consecutive failures that open the breaker. 0 turns it off.
+        :param reset_timeout_seconds: How long to stay open before trying again
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout_seconds
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._state = CLOSED
+        BREAKER_STATE.set(0, dependency=name)
+
+    @property
+    def state(self) -> str:
+        if (
+            self._state == OPEN
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            return HALF_OPEN
+        return self._state
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            self.logger.warning(f"Circuit breaker for {self.name} is now {state}")
+        self._state = state
+        BREAKER_STATE.set(_STATE_VALUES[state], dependency=self.name)
+
+    def _open_error(self) -> CircuitOpen:
+        remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+        return CircuitOpen(self.name, retry_after=max(1, round(remaining)))
+
+    def check(self):
+        """
+        Fail fast while the breaker is open, without taking the half open trial. For callers about to queue up for the
+        dependency, so they don't wait their turn only to be turned away.
+        :raises CircuitOpen:
+        """
+        if self.failure_threshold > 0 and self.state == OPEN:
+            raise self._open_error()
+
+    def before_call(self):
+        """
+        :raises CircuitOpen: If the call shouldn't be made
+        """
+        if self.failure_threshold <= 0:
+            return
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self._trial_in_flight:
+            self._set_state(HALF_OPEN)
+            self._trial_in_flight = True
+            return
+        raise self._open_error()
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_in_flight = False
+        if self._state != CLOSED:
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failure_threshold > 0 and (
+            self._state == HALF_OPEN or self.failures >= self.failure_threshold
+        ):
+            self._opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def release(self):
+        # The call ended without telling us anything (cancelled by a deadline, say), so let another one try.
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class RetryPolicy:
+    """
+    Retries transient failures with exponential backoff and full jitter: the nth retry sleeps a random time between 0
+    and min(max_delay, base_delay * 2^n). The randomness keeps a crowd of requests that failed together from all coming
+    back at the same moment and knocking over the dependency as it recovers.
+    """
+
+    def __init__(
+        self, max_retries: int = 2, base_delay: float = 0.1, max_delay: float = 2.0
+    ):
+        """
+        :param max_retries: Retries after the first attempt. 0 for none.
+        :param base_delay: Backoff ceiling for the first retry in seconds, doubled for every retry after
+        :param max_delay: Upper bound of the backoff ceiling in seconds
+        """
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable],
+        is_transient: Callable[[Exception], bool],
+        breaker: CircuitBreaker | None = None,
+    ):
+        """
+        Make the call, retrying transient failures, with every attempt going through the breaker.
+        :param call: Makes a fresh attempt every time it's called
+        :param is_transient: Whether a failure is worth retrying and counts against the dependency. Anything else
+        (a bad request, say) goes straight back to the caller and shows the dependency is up.
+        :param breaker: The dependency's circuit breaker
+        :return: What the call returned
+        :raises CircuitOpen: When the breaker is open, before or between attempts
+        """
+        retry = 0
+        while True:
+            if breaker:
+                breaker.before_call()
+            try:
+                result = await call()
+            except Exception as e:
+                transient = is_transient(e)
+                if breaker and transient:
+                    breaker.record_failure()
+                elif breaker:
+                    breaker.record_success()
+                if not transient or retry >= self.max_retries:
+                    raise
+            except BaseException:
+                if breaker:
+                    breaker.release()
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
+            delay = self.backoff(retry)
+            retry += 1
+            name = breaker.name if breaker else "dependency"
+            DEPENDENCY_RETRIES.inc(dependency=name)
+            self.logger.info(
+                f"Retrying {name} in {delay:.2f}s after a transient failure ({retry}/{self.max_retries})"
+            )
+            await asyncio.sleep(delay)
@@ -5,32 +5,82 @@ import os
 # "The current process just got forked, after parallelism has already been used..."
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+import asyncio
 import logging
+import time
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router
 from core.config import Config
+from core.metrics import REGISTRY, MetricsMiddleware
 from services.chat_service import RAGAgent
-from services.search_service import ESSearch
+from services.search_service import ESSearch, VectorSearch
 
 logger = logging.getLogger(__name__)
 
 
 class AppState:
     agent: RAGAgent
+    ready: bool = False
+    warmup_error: str | None = None
+
+
+def build_search_service(config: Config) -> VectorSearch:
+    if config.search_backend == "local":
+        from services.local_search import LocalVectorSearch
+
+        logger.info("Using the local in-process vector index")
+        return LocalVectorSearch(config)
+    if config.search_backend != "elasticsearch":
+        raise ValueError(f"Unknown SEARCH_BACKEND '{config.search_backend}'")
+    return ESSearch(config)
+
+
+async def warm_up(state: AppState, config: Config):
+    """
+    Load the models and check the backends in the background, then flip the app to ready. Until then /health/ready
+    answers 503, so a rolling deploy keeps sending traffic to the old pods instead of making users wait for this one.
+    Anything that fails (ES not up yet, say) is retried until it works.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.perf_counter()
+        try:
+            await state.agent.warm_up(ping_llm=config.warmup_ping_llm)
+        except Exception as e:
+            state.warmup_error = f"{type(e).__name__}: {e}"
+            logger.warning(
+                f"Warm-up attempt {attempt} failed, retrying in {config.warmup_retry_seconds}s: {state.warmup_error}"
+            )
+            await asyncio.sleep(config.warmup_retry_seconds)
+            continue
+        state.warmup_error = None
+        state.ready = True
+        logger.info(
+            f"Warm-up finished in {time.perf_counter() - start:.1f}s, ready for traffic"
+        )
+        return
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     config = Config()
-    search = ESSearch(config)
+    search = build_search_service(config)
     logger.info("Initializing RAGAgent")
     agent = RAGAgent(config, search)
     app.state = AppState
     app.state.agent = agent
+    app.state.ready = False
+    # Warm-up runs alongside serving rather than before it, so the liveness probe gets answered straight away.
+    warmup_task = asyncio.create_task(warm_up(app.state, config))
     yield
     logger.info("Shutting down RAGAgent...")
+    warmup_task.cancel()
+    search.close()
+    await config.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -50,9 +100,48 @@ if allowed_origins:
         allow_credentials=False,
     )
 
+# Per request stage timings (embed, search, es, context, llm...) in a Server-Timing header, and in the "done" event of a
+# stream. Off by default since it tells clients a fair bit about our internals.
+app.add_middleware(
+    MetricsMiddleware,
+    server_timing_header=os.getenv("SERVER_TIMING_HEADER", "false").lower() == "true",
+)
+
 app.include_router(router, prefix="/api")
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/health/live", include_in_schema=False)
+def live():
+    # The process is up and the event loop is turning. Says nothing about whether we can answer questions yet.
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+def ready():
+    state = app.state
+    if not getattr(state, "ready", False):
+        body = {"status": "warming up"}
+        if getattr(state, "warmup_error", None):
+            body["error"] = state.warmup_error
+        return JSONResponse(body, status_code=503)
+    # An open breaker doesn't make us unready. Every pod shares the same backends, so pulling this one out of the load
+    # balancer wouldn't help anyone, while degraded answers and fast 503s still beat no answer at all.
+    config = state.agent.config
+    dependencies = {"llm": config.llm_breaker.stats()}
+    # The local backend searches in process, ES isn't involved at all then.
+    if config.search_backend == "elasticsearch":
+        dependencies["elasticsearch"] = config.es_breaker.stats()
+    return {"status": "ready", "dependencies": dependencies}
+
+
 @app.get("/")
 def root():
     return {"message": "Eldritch Oracle RAG API is running"}
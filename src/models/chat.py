@@ -1,6 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Literal
 
+from models.search import BatchError
+
 
 class ChatMessage(BaseModel):
     role: Literal["user", "assistant", "system"]
@@ -9,6 +11,25 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     messages: list[ChatMessage]
+    # Skip the semantic answer cache and always ask the LLM for a fresh answer.
+    bypass_cache: bool = False
+    # Any id the client picks for the conversation, the same on every turn. With it, follow-up questions on the same
+    # subject reuse the chunks retrieved earlier in the conversation instead of searching again.
+    conversation_id: str | None = Field(default=None, max_length=128)
+
+
+class ChatBatchRequest(BaseModel):
+    requests: list[ChatRequest] = Field(min_length=1)
+
+
+class ChatBatchItem(BaseModel):
+    message: ChatMessage | None = None
+    error: BatchError | None = None
+
+
+class ChatBatchResponse(BaseModel):
+    # One item per request, in order
+    results: list[ChatBatchItem]
 
 
 class ChatResponse(BaseModel):
@@ -0,0 +1,37 @@
+from typing import Annotated
+
+from pydantic import BaseModel, Field
+
+
+class SearchHit(BaseModel):
+    story_title: str
+    chunk_id: int
+    text: str
+    source: str | None = None
+    start_token: int
+    end_token: int
+    score: float
+
+
+class BatchError(BaseModel):
+    # The status code the item would have had as a request of its own
+    status_code: int
+    detail: str
+    # Seconds to wait before retrying, when the item was turned away for overload or an unavailable backend
+    retry_after: int | None = None
+
+
+class SearchBatchRequest(BaseModel):
+    queries: list[Annotated[str, Field(min_length=1)]] = Field(min_length=1)
+    # Hits per query, defaults to TOP_K_ES_RESULTS
+    top_k: int | None = Field(default=None, ge=1, le=100)
+
+
+class SearchBatchItem(BaseModel):
+    hits: list[SearchHit] | None = None
+    error: BatchError | None = None
+
+
+class SearchBatchResponse(BaseModel):
+    # One item per query, in order
+    results: list[SearchBatchItem]
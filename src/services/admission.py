@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import math
+from contextlib import asynccontextmanager
+
+from core.metrics import QUEUE_SECONDS, REQUESTS_REJECTED, timed
+
+
+class Overloaded(Exception):
+    """
+    Raised instead of queueing a request we can't serve in reasonable time. The API turns it into status_code with a
+    Retry-After header.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def deadline_after(seconds: float) -> float | None:
+    """
+    :param seconds: Time budget from now, 0 or less for none
+    :return: An absolute deadline on the event loop clock for asyncio.timeout_at, None meaning no deadline
+    """
+    if seconds <= 0:
+        return None
+    return asyncio.get_running_loop().time() + seconds
+
+
+class AdmissionController:
+    """
+    Limits how many LLM calls are in flight at once, with a bounded queue in front.
+
+    Ollama and vLLM don't refuse work when they're saturated, they just get slower for everyone, so without a limit a
+    burst turns into every request timing out together. Here at most max_concurrency calls run at once and up to
+    max_queue more wait their turn, in arrival order. Beyond that we shed load straight away with a 429, and a request
+    that waited in the queue longer than queue_timeout_seconds gets a 503, both with a Retry-After estimated from how
+    long calls have been taking. That keeps latency for the requests we do accept steady, and tells the rest when to
+    come back.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        max_queue: int = 32,
+        queue_timeout_seconds: float = 10,
+    ):
+        """
+        :param max_concurrency: LLM calls allowed in flight. 0 turns admission control off.
+        :param max_queue: Requests allowed to wait for a slot. Past that they're rejected.
+        :param queue_timeout_seconds: Longest a request waits for a slot. 0 means until its deadline.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout_seconds
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self.waiting = 0
+        self.active = 0
+        # Moving average of how long a call holds its slot, for the Retry-After estimate
+        self._hold_seconds = 1.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    def _retry_after(self) -> int:
+        # Roughly how long until the queue ahead of a new request has drained.
+        return max(
+            1, math.ceil(self._hold_seconds * (self.waiting + 1) / self.max_concurrency)
+        )
+
+    @asynccontextmanager
+    async def slot(self, deadline: float | None = None):
+        """
+        Hold one of the LLM slots for the duration of the block, waiting in the queue for it if need be.
+        :param deadline: The request's own deadline (event loop time). If that comes before the queue timeout, running
+        out of time in the queue is a TimeoutError like anywhere else in the request, rather than Overloaded.
+        """
+        if not self.enabled:
+            yield
+            return
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            REQUESTS_REJECTED.inc(reason="queue_full")
+            raise Overloaded(
+                f"Too many requests, {self.active} in flight and {self.waiting} queued",
+                status_code=429,
+                retry_after=self._retry_after(),
+            )
+        loop = asyncio.get_running_loop()
+        queue_deadline = (
+            loop.time() + self.queue_timeout if self.queue_timeout else None
+        )
+        wait_until = min(
+            (d for d in (deadline, queue_deadline) if d is not None), default=None
+        )
+        self.waiting += 1
+        try:
+            with timed(QUEUE_SECONDS, "queue"):
+                async with asyncio.timeout_at(wait_until):
+                    await self._semaphore.acquire()
+        except TimeoutError:
+            if wait_until != queue_deadline:
+                raise
+            REQUESTS_REJECTED.inc(reason="queue_timeout")
+            raise Overloaded(
+                f"Timed out after {self.queue_timeout}s waiting for the inference server",
+                status_code=503,
+                retry_after=self._retry_after(),
+            ) from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        start = loop.time()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            held = loop.time() - start
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+        }
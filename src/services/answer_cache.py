@@ -0,0 +1,108 @@
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from core.metrics import CACHE_LOOKUPS
+
+
+class SemanticAnswerCache:
+    """
+    Caches finished answers by the embedding of the question that produced them.
+
+    A new question is compared against every cached question with a single matrix-vector product (the embeddings are
+    normalized, so the dot product is cosine similarity). If the best match clears the threshold, its answer is reused
+    and the LLM call is skipped entirely. That's how "What's a shoggoth?" can be served from the answer we gave to
+    "What is a shoggoth?" a minute ago.
+
+    The vectors live in one preallocated float32 matrix with a slot per entry. Entries are evicted LRU once the cache is
+    full, and lazily when they're older than the TTL.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+        threshold: float = 0.95,
+    ):
+        """
+        :param max_entries: How many answers to keep. 0 turns the cache off.
+        :param ttl_seconds: How long an answer may be reused. 0 means until evicted.
+        :param threshold: Minimum cosine similarity between questions for a cached answer to be reused.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._matrix: np.ndarray | None = None
+        self._valid = np.zeros(max(max_entries, 0), dtype=bool)
+        # When each slot was stored, so expired entries can be masked out along with the empty slots
+        self._created = np.zeros(max(max_entries, 0), dtype=np.float64)
+        # slot -> answer, in least to most recently used order
+        self._entries: OrderedDict[int, str] = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def lookup(self, vector: list[float]) -> str | None:
+        if not self.enabled:
+            return None
+        answer = self._lookup(vector)
+        CACHE_LOOKUPS.inc(cache="answer", result="miss" if answer is None else "hit")
+        return answer
+
+    def _evict_expired(self):
+        # Expired entries go before the argmax, so a stale best match can't hide a valid one just below it.
+        if not self.ttl:
+            return
+        expired = self._valid & (self._created < time.time() - self.ttl)
+        for slot in np.flatnonzero(expired):
+            self._evict(int(slot))
+
+    def _lookup(self, vector: list[float]) -> str | None:
+        self._evict_expired()
+        if not self._entries:
+            self.misses += 1
+            return None
+        scores = self._matrix @ np.asarray(vector, dtype=np.float32)
+        scores[~self._valid] = -np.inf
+        slot = int(np.argmax(scores))
+        answer = self._entries[slot]
+        if scores[slot] < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(slot)
+        self.hits += 1
+        self.logger.debug(f"Semantic cache hit with similarity {scores[slot]:.3f}")
+        return answer
+
+    def store(self, vector: list[float], answer: str):
+        if not self.enabled or not answer:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), np.float32)
+        if not self._free_slots:
+            self._evict(next(iter(self._entries)))
+        slot = self._free_slots.pop()
+        self._matrix[slot] = vector
+        self._valid[slot] = True
+        self._created[slot] = time.time()
+        self._entries[slot] = answer
+
+    def _evict(self, slot: int):
+        del self._entries[slot]
+        self._valid[slot] = False
+        self._free_slots.append(slot)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,37 +1,150 @@
+import asyncio
 import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import aclosing
 
 from models.chat import ChatMessage, ChatRequest
-from services.search_service import ESSearch
+from models.search import SearchHit
+from services.admission import AdmissionController
+from services.answer_cache import SemanticAnswerCache
+from services.context_service import ContextAssembler
+from services.search_service import VectorSearch, latest_user_message
+from services.session_store import REUSE, SessionStore
 from core.config import Config
+from core.resilience import CircuitOpen
+from core.metrics import (
+    CONTEXT_SECONDS,
+    DEGRADED_ANSWERS,
+    LLM_SECONDS,
+    LLM_TOKENS,
+    LLM_TTFT_SECONDS,
+    REQUESTS_REJECTED,
+    record_timing,
+    timed,
+)
+
+
+def llm_transient(e: Exception) -> bool:
+    """
+    Whether an inference server failure is worth retrying and holding against it: it couldn't be reached, timed out,
+    is overloaded (429) or broke (5xx). A request it rejected as invalid isn't.
+    """
+    import openai
+
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    return isinstance(e, openai.APIStatusError) and (
+        e.status_code >= 500 or e.status_code == 429
+    )
 
 
 class RAGAgent:
-    def __init__(self, config: Config, search_service: ESSearch):
-        self.openai_client = config.openai_client
+    def __init__(self, config: Config, search_service: VectorSearch):
         self.search_service = search_service
         self.config = config
+        self.context_assembler = ContextAssembler(config)
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.answer_cache = SemanticAnswerCache(
+            max_entries=config.answer_cache_size,
+            ttl_seconds=config.answer_cache_ttl_seconds,
+            threshold=config.answer_cache_threshold,
+        )
+        self.sessions = SessionStore(
+            max_sessions=config.session_store_size,
+            idle_ttl_seconds=config.session_ttl_seconds,
+            reuse_threshold=config.session_reuse_threshold,
+            extend_threshold=config.session_extend_threshold,
+            max_hits=config.session_max_hits,
+        )
+        self.admission = AdmissionController(
+            max_concurrency=config.llm_max_concurrency,
+            max_queue=config.llm_max_queue,
+            queue_timeout_seconds=config.llm_queue_timeout_seconds,
+        )
 
-    def generate_response(self, request: ChatRequest) -> ChatMessage:
+    @property
+    def openai_client(self):
+        return self.config.openai_client
+
+    async def warm_up(self, ping_llm: bool = False):
         """
-        This is a super basic RAG flow so we are doing no fancy things or introducing any elaborate libraries. This is to
-        demonstrate what barebones RAG actually looks like. With a big context window, you can actually do a lot before
-        getting into adding extra complexity.
+        Load everything the first request would otherwise wait for: the encoder (and ES connection, for that backend),
+        the context tokenizer and the OpenAI client. Raises if any of it isn't there yet, the caller retries.
+        :param ping_llm: Also list the models on the inference server to check it answers.
+        """
+        await self.search_service.warm_up()
+        await asyncio.to_thread(self.context_assembler.count_tokens, "warm up")
+        # Creating the client imports the OpenAI library, which is slow enough to keep off the event loop.
+        openai_client = await asyncio.to_thread(lambda: self.config.openai_client)
+        if ping_llm:
+            await openai_client.models.list()
 
-        The flow is as follows:
-        1. Use the user message to query for the docs in ElasticSearch that are most similar
-        2. Use the search results as part of the system prompt which is sent along with the user's message to the LLM
-        which will then factor the whole thing into the generated response.
+    def _cacheable(self, request: ChatRequest) -> bool:
+        if request.bypass_cache or not self.answer_cache.enabled:
+            return False
+        return not any(m.role == "assistant" for m in request.messages)
+
+    async def _cache_vector(self, request: ChatRequest) -> list[float] | None:
+        """
+        Work out whether this request may use the semantic answer cache and if so return the embedding of the question.
+        Only first-turn questions qualify, since once there's an assistant turn in the history the right answer
+        depends on the whole conversation and not just the latest message. The same embedding is reused for retrieval
+        so asking the cache costs nothing extra.
+        :param request:
+        :return: The query embedding, or None if the cache should be skipped.
+        """
+        if not self._cacheable(request):
+            return None
+        question = latest_user_message(request.messages)
+        if not question:
+            return None
+        return await self.search_service.embed_query(question)
 
+    async def _retrieve(
+        self, request: ChatRequest, query_vector: list[float] | None = None
+    ) -> list[SearchHit]:
+        """
+        Search for the latest question, or for a conversation we've seen before, work from what its earlier turns
+        retrieved. See SessionStore for when that skips the search.
         :param request:
-        :return: The response message from the assistant.
+        :param query_vector: The embedding of the latest user message, if we already computed it.
+        :return: The hits to build the context from
         """
-        # First we use the user query to get the relevant chunk(s) from our ES service. These are joined and used to contribute to
-        # the system prompt
-        context_chunks: list[str] = self.search_service.search(
-            request.messages, top_k=1
+        question = latest_user_message(request.messages)
+        if not request.conversation_id or not self.sessions.enabled or not question:
+            return await self.search_service.search(
+                request.messages,
+                top_k=self.config.top_k_search_results,
+                query_vector=query_vector,
+            )
+        query_vector = query_vector or await self.search_service.embed_query(question)
+        decision, hits = self.sessions.plan(request.conversation_id, query_vector)
+        if decision == REUSE:
+            return hits
+        hits = await self.search_service.search(
+            request.messages,
+            top_k=self.config.top_k_search_results,
+            query_vector=query_vector,
+        )
+        return self.sessions.update(
+            request.conversation_id, decision, query_vector, hits
         )
-        context_text = "\n\n".join(c for c in context_chunks)
+
+    def _prompt_from_hits(
+        self, request: ChatRequest, hits: list[SearchHit]
+    ) -> list[dict]:
+        """
+        Put together the message list we send to the LLM. Shared by all the chat paths so they always see the same
+        prompt.
+        :param request:
+        :param hits: What retrieval found for the latest question
+        :return: The OpenAI style list of message dicts
+        """
+        # Overlapping chunks are merged and the text is packed into the context token budget to contribute to the
+        # system prompt
+        with timed(CONTEXT_SECONDS, "context"):
+            context_text = self.context_assembler.assemble(hits)
         # This must be kept really small for our purposes on a local machine as Ollama defaults to a very small context window
         # and we're using the default via the OpenAI client. It's easy to enlarge to what the model can handle via the real
         # Ollama interface.
@@ -45,12 +158,320 @@ You must use the following context to help write your reply: {context_text}"""
         # Add the incoming conversation messages
         final_prompt.extend([msg.model_dump() for msg in request.messages])
         self.logger.debug(final_prompt)
-        response = self.openai_client.chat.completions.create(
-            model=self.config.inference_model_name,
-            messages=final_prompt,
-            max_tokens=1024,
-            temperature=0.5,
+        return final_prompt
+
+    @staticmethod
+    def _record_usage(usage, completion_chunks: int | None = None):
+        # Not every OpenAI compatible server reports usage. For a stream we can at least count the content chunks,
+        # which is one token each on vLLM and Ollama.
+        if usage is not None:
+            LLM_TOKENS.observe(usage.prompt_tokens, kind="prompt")
+            LLM_TOKENS.observe(usage.completion_tokens, kind="completion")
+        elif completion_chunks is not None:
+            LLM_TOKENS.observe(completion_chunks, kind="completion")
+
+    async def generate_response(
+        self, request: ChatRequest, deadline: float | None = None
+    ) -> ChatMessage:
+        """
+        This is a super basic RAG flow so we are doing no fancy things or introducing any elaborate libraries. This is to
+        demonstrate what barebones RAG actually looks like. With a big context window, you can actually do a lot before
+        getting into adding extra complexity.
+
+        The flow is as follows:
+        1. Use the user message to query for the docs in ElasticSearch that are most similar
+        2. Use the search results as part of the system prompt which is sent along with the user's message to the LLM
+        which will then factor the whole thing into the generated response.
+
+        Before any of that, first-turn questions are checked against the semantic answer cache and a close enough
+        match is returned without calling the LLM at all.
+
+        The LLM call waits its turn for an admission slot, and the whole flow runs against the deadline. Whatever is in
+        flight when it passes is cancelled, the inference server request included.
+
+        :param request:
+        :param deadline: Event loop time by which we must be done (see deadline_after), None for no limit
+        :return: The response message from the assistant.
+        :raises Overloaded: When the LLM queue is full or we waited in it too long
+        :raises TimeoutError: When the deadline passes
+        """
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await self._generate(request, deadline)
+        except TimeoutError:
+            REQUESTS_REJECTED.inc(reason="deadline")
+            raise
+
+    async def _generate(
+        self, request: ChatRequest, deadline: float | None
+    ) -> ChatMessage:
+        query_vector = await self._cache_vector(request)
+        if query_vector is not None:
+            cached = self.answer_cache.lookup(query_vector)
+            if cached is not None:
+                return ChatMessage(role="assistant", content=cached)
+        # First we use the user query to get the relevant chunk(s) from our ES service.
+        hits = await self._retrieve(request, query_vector)
+        try:
+            content = await self._complete(
+                self._prompt_from_hits(request, hits), deadline
+            )
+        except Exception as e:
+            degraded = self._degraded_answer(e, hits)
+            if degraded is None:
+                raise
+            return ChatMessage(role="assistant", content=degraded)
+        if query_vector is not None:
+            self.answer_cache.store(query_vector, content)
+        return ChatMessage(role="assistant", content=content)
+
+    async def _complete(self, final_prompt: list[dict], deadline: float | None) -> str:
+        # No point queueing for a slot when the inference server is known to be down.
+        self.config.llm_breaker.check()
+        async with self.admission.slot(deadline):
+            with timed(LLM_SECONDS, "llm", stream="false"):
+                response = await self.config.llm_retry.run(
+                    lambda: self.openai_client.chat.completions.create(
+                        model=self.config.inference_model_name,
+                        messages=final_prompt,
+                        max_tokens=1024,
+                        temperature=0.5,
+                    ),
+                    llm_transient,
+                    self.config.llm_breaker,
+                )
+        self._record_usage(response.usage)
+        return response.choices[0].message.content
+
+    def _degraded_answer(self, error: Exception, hits: list[SearchHit]) -> str | None:
+        """
+        With DEGRADED_ANSWERS on, a question the LLM couldn't answer because it's down (its breaker is open, or it kept
+        failing through the retries) gets the passages we retrieved for it instead of an error. Not the answer they
+        asked for, but the excerpts are usually what it would have been built on.
+        :param error: Why the completion failed
+        :param hits: What retrieval found
+        :return: The fallback answer, or None if this failure doesn't call for one
+        """
+        if not self.config.degraded_answers or not hits:
+            return None
+        if not isinstance(error, CircuitOpen) and not llm_transient(error):
+            return None
+        DEGRADED_ANSWERS.inc()
+        self.logger.warning(
+            f"Serving a retrieval only answer, the LLM failed with {type(error).__name__}: {error}"
         )
-        return ChatMessage(
-            role="assistant", content=response.choices[0].message.content
+        passages = [
+            f'From "{hit.story_title}":\n{hit.text}'
+            for hit in self.context_assembler.dedupe(hits)[:3]
+        ]
+        return (
+            "The oracle cannot speak right now, but these passages from Lovecraft's stories seem closest to your "
+            "question:\n\n" + "\n\n".join(passages)
         )
+
+    async def generate_batch(
+        self, requests: list[ChatRequest], deadline: float | None = None
+    ) -> list[ChatMessage | Exception]:
+        """
+        Answer a batch of independent questions, for offline jobs like eval runs. Rather than running the regular flow
+        once per request, every question is embedded in one encode call and retrieved for in one search round trip (a
+        single _msearch on ES), then the completions run concurrently, at most BATCH_LLM_CONCURRENCY of them at a time
+        and still through the admission control.
+
+        Each item is one conversation with its own history, but conversation_id is ignored here: batch items don't
+        read or update the per conversation retrieval sessions. The answer cache works as usual.
+        :param requests:
+        :param deadline: Event loop time by which the whole batch must be done, None for no limit
+        :return: The answer for each request in order, or the exception that item failed with
+        :raises TimeoutError: When the deadline passes before retrieval is done. Later on only the unfinished items fail.
+        Any other retrieval failure fails the items that weren't cache hits.
+        """
+        results: list[ChatMessage | Exception | None] = [None] * len(requests)
+        questions = [latest_user_message(r.messages) for r in requests]
+        todo = []
+        for i, question in enumerate(questions):
+            if question:
+                todo.append(i)
+            else:
+                results[i] = ValueError("No user message to answer")
+
+        try:
+            async with asyncio.timeout_at(deadline):
+                vectors = dict(
+                    zip(
+                        todo,
+                        await self.search_service.embed_queries(
+                            [questions[i] for i in todo]
+                        ),
+                    )
+                )
+                to_search = []
+                for i in todo:
+                    if self._cacheable(requests[i]):
+                        cached = self.answer_cache.lookup(vectors[i])
+                        if cached is not None:
+                            results[i] = ChatMessage(role="assistant", content=cached)
+                            continue
+                    to_search.append(i)
+                # Nothing left to search when every item was answered from the cache or had no question.
+                hits = []
+                if to_search:
+                    hits = await self.search_service.search_many(
+                        [questions[i] for i in to_search],
+                        top_k=self.config.top_k_search_results,
+                        query_vectors=[vectors[i] for i in to_search],
+                    )
+        except TimeoutError:
+            REQUESTS_REJECTED.inc(reason="deadline")
+            raise
+        except Exception as e:
+            # Embedding or the search round trip failed for the batch as a whole (ES down, its breaker open...). That
+            # fails the items that needed it with the error each would have had on its own, but keeps the cache hits.
+            self.logger.warning(f"Batch retrieval failed: {type(e).__name__}: {e}")
+            for i in todo:
+                if results[i] is None:
+                    results[i] = e
+            return results
+
+        fan_out = asyncio.Semaphore(max(1, self.config.batch_llm_concurrency))
+
+        async def answer(i: int, item_hits: list[SearchHit]) -> ChatMessage | Exception:
+            async with fan_out:
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        content = await self._complete(
+                            self._prompt_from_hits(requests[i], item_hits), deadline
+                        )
+                except TimeoutError as e:
+                    REQUESTS_REJECTED.inc(reason="deadline")
+                    return e
+                except Exception as e:
+                    degraded = self._degraded_answer(e, item_hits)
+                    if degraded is not None:
+                        return ChatMessage(role="assistant", content=degraded)
+                    self.logger.warning(
+                        f"Batch item {i} failed: {type(e).__name__}: {e}"
+                    )
+                    return e
+            if self._cacheable(requests[i]):
+                self.answer_cache.store(vectors[i], content)
+            return ChatMessage(role="assistant", content=content)
+
+        pending = []
+        for i, item_hits in zip(to_search, hits):
+            if isinstance(item_hits, Exception):
+                results[i] = item_hits
+            else:
+                pending.append((i, item_hits))
+        answers = await asyncio.gather(*(answer(i, h) for i, h in pending))
+        for (i, _), result in zip(pending, answers):
+            results[i] = result
+        return results
+
+    async def stream_response(
+        self, request: ChatRequest, deadline: float | None = None
+    ) -> AsyncIterator[str]:
+        """
+        Same RAG flow as generate_response, but the completion is requested with stream=True and each token is yielded
+        as soon as the inference server sends it. Users see the first words after retrieval plus prefill instead of
+        after the whole completion.
+
+        If the consumer stops iterating (the client hung up), closing this generator closes the upstream response. That
+        drops the connection to the inference server, which is how vLLM and Ollama know to abort the generation. The
+        same happens when the deadline passes mid-stream.
+
+        A semantic cache hit is sent as a single chunk. Only answers that streamed to completion are cached.
+        :param request:
+        :param deadline: Event loop time by which the stream must be finished, None for no limit
+        :return: An async iterator of content deltas.
+        :raises Overloaded: Before the first token, when the LLM queue is full or we waited in it too long
+        :raises TimeoutError: When the deadline passes
+        """
+        try:
+            async for token in self._stream(request, deadline):
+                yield token
+        except TimeoutError:
+            REQUESTS_REJECTED.inc(reason="deadline")
+            raise
+
+    async def _stream(
+        self, request: ChatRequest, deadline: float | None
+    ) -> AsyncIterator[str]:
+        # The deadline is applied around each await rather than as one block around the lot. The consumer may iterate
+        # us from more than one task (Starlette streams from its own), and a timeout only cancels the task it was
+        # entered in, so it mustn't stay open across a yield.
+        cached = None
+        async with asyncio.timeout_at(deadline):
+            query_vector = await self._cache_vector(request)
+            if query_vector is not None:
+                cached = self.answer_cache.lookup(query_vector)
+            if cached is None:
+                hits = await self._retrieve(request, query_vector)
+                final_prompt = self._prompt_from_hits(request, hits)
+        if cached is not None:
+            yield cached
+            return
+        tokens = []
+        try:
+            self.config.llm_breaker.check()
+            async with self.admission.slot(deadline):
+                async with aclosing(
+                    self._stream_completion(final_prompt, deadline)
+                ) as completion:
+                    async for token in completion:
+                        tokens.append(token)
+                        yield token
+        except Exception as e:
+            # Once part of the answer is out there's no swapping it for another one.
+            degraded = None if tokens else self._degraded_answer(e, hits)
+            if degraded is None:
+                raise
+            yield degraded
+            return
+        if query_vector is not None:
+            self.answer_cache.store(query_vector, "".join(tokens))
+
+    async def _stream_completion(
+        self, final_prompt: list[dict], deadline: float | None
+    ) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        async with asyncio.timeout_at(deadline):
+            stream = await self.config.llm_retry.run(
+                lambda: self.openai_client.chat.completions.create(
+                    model=self.config.inference_model_name,
+                    messages=final_prompt,
+                    max_tokens=1024,
+                    temperature=0.5,
+                    stream=True,
+                    # Ask for a final usage chunk so we can count prompt and completion tokens.
+                    stream_options={"include_usage": True},
+                ),
+                llm_transient,
+                self.config.llm_breaker,
+            )
+        completion_chunks = 0
+        usage = None
+        try:
+            chunks = aiter(stream)
+            while True:
+                async with asyncio.timeout_at(deadline):
+                    chunk = await anext(chunks, None)
+                if chunk is None:
+                    break
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if token:
+                    if not completion_chunks:
+                        ttft = time.perf_counter() - start
+                        LLM_TTFT_SECONDS.observe(ttft)
+                        record_timing("llm_ttft", ttft)
+                    completion_chunks += 1
+                    yield token
+        finally:
+            await stream.close()
+            elapsed = time.perf_counter() - start
+            LLM_SECONDS.observe(elapsed, stream="true")
+            record_timing("llm", elapsed)
+        self._record_usage(usage, completion_chunks=completion_chunks)
@@ -0,0 +1,113 @@
+import logging
+
+from core.config import Config
+from models.search import SearchHit
+
+
+class ContextAssembler:
+    """
+    Turns search hits into the context block of the system prompt.
+
+    Neighbouring chunks of a story overlap (prep_docs slides its window), so two hits from the same story often repeat
+    the same sentences. Those get merged into one passage using their token spans before anything is packed. Then
+    passages go in best score first, text only, until the token budget runs out. The budget is measured with a real
+    tokenizer rather than guessed from character counts, so what we think fits actually fits.
+    """
+
+    def __init__(self, config: Config):
+        self.token_budget: int = config.context_token_budget
+        self.tokenizer_name: str = config.context_tokenizer
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        encoded = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )
+        offsets = encoded["offset_mapping"]
+        if len(offsets) <= max_tokens:
+            return text
+        return text[: offsets[max_tokens - 1][1]]
+
+    @staticmethod
+    def _merge_text(first: SearchHit, second: SearchHit) -> str:
+        # The overlap is made of whole sentences joined the same way in both chunks, so the tail of the earlier chunk
+        # is exactly the head of the later one. Find where that tail starts and stitch the two together there.
+        head = second.text.split(" ", 1)[0]
+        idx = first.text.find(head) if head else -1
+        while idx >= 0:
+            if second.text.startswith(first.text[idx:]):
+                return first.text[:idx] + second.text
+            idx = first.text.find(head, idx + 1)
+        return first.text + " " + second.text
+
+    def dedupe(self, hits: list[SearchHit]) -> list[SearchHit]:
+        """
+        Merge hits from the same story whose token spans overlap, and drop hits that are fully contained in another.
+        The merged passage keeps the best score of its parts. The result is ordered best score first.
+        :param hits:
+        :return: The deduplicated hits
+        """
+        by_story: dict[tuple, list[SearchHit]] = {}
+        for hit in hits:
+            by_story.setdefault((hit.story_title, hit.source), []).append(hit)
+
+        merged: list[SearchHit] = []
+        for story_hits in by_story.values():
+            story_hits.sort(key=lambda h: (h.start_token, -h.end_token))
+            current = story_hits[0]
+            for hit in story_hits[1:]:
+                if hit.start_token >= current.end_token:
+                    merged.append(current)
+                    current = hit
+                elif hit.end_token <= current.end_token:
+                    current = current.model_copy(
+                        update={"score": max(current.score, hit.score)}
+                    )
+                else:
+                    current = current.model_copy(
+                        update={
+                            "text": self._merge_text(current, hit),
+                            "end_token": hit.end_token,
+                            "score": max(current.score, hit.score),
+                        }
+                    )
+            merged.append(current)
+        merged.sort(key=lambda h: h.score, reverse=True)
+        return merged
+
+    def assemble(self, hits: list[SearchHit]) -> str:
+        """
+        Dedupe the hits and pack their text into the token budget, best first. A passage that doesn't fit is skipped
+        so a shorter one further down can still use the space, except the very first which gets truncated rather than
+        leaving the prompt without any context.
+        :param hits:
+        :return: The context text for the system prompt
+        """
+        separator = "\n\n"
+        separator_tokens = self.count_tokens(separator)
+        packed: list[str] = []
+        used = 0
+        for hit in self.dedupe(hits):
+            cost = self.count_tokens(hit.text) + (separator_tokens if packed else 0)
+            if used + cost <= self.token_budget:
+                packed.append(hit.text)
+                used += cost
+            elif not packed:
+                packed.append(self._truncate(hit.text, self.token_budget))
+                used = self.token_budget
+        self.logger.debug(
+            f"Packed {len(packed)} of {len(hits)} hits into {used}/{self.token_budget} context tokens"
+        )
+        return separator.join(packed)
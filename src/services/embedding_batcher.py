@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from collections.abc import Callable
+
+from core.metrics import ENCODE_BATCH_SIZE, ENCODE_SECONDS, timed
+
+
+class EmbeddingBatcher:
+    """
+    Collects concurrent embedding requests and runs them through the encoder as one batch.
+
+    Encoding one short query at a time leaves most of the model's throughput on the table, especially on CPU. Each
+    call to embed() parks the text in a pending list, and a single consumer task takes the whole list to the encoder as
+    one encode call. When the encoder is idle the first text waits for company until max_batch_size texts are pending
+    or it has waited max_wait_ms, whichever comes first. Every caller then gets back its own vector.
+
+    Only one batch is encoded at a time. While the encoder is busy, new requests keep piling up, and as soon as it's
+    free the consumer takes everything that piled up (up to max_batch_size) straight away, so the next batch is bigger,
+    which is exactly what we want under load. With no concurrency the cost is at most max_wait_ms of extra latency.
+    """
+
+    def __init__(
+        self,
+        encode_batch: Callable[[list[str]], list[list[float]]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+    ):
+        """
+        :param encode_batch: Blocking function taking a list of texts and returning one vector per text, in order.
+        It runs in a worker thread.
+        :param max_batch_size: Most texts in one encode call. An idle encoder starts as soon as this many are waiting.
+        :param max_wait_ms: How long a text that finds the encoder idle waits for others to join its batch.
+        """
+        self.encode_batch = encode_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        # Set once a full batch is waiting, to cut the idle wait short.
+        self._full = asyncio.Event()
+        self._encode_lock: asyncio.Lock | None = None
+        # The consumer task while there's pending work, also so it doesn't get garbage collected mid-encode.
+        self._consumer: asyncio.Task | None = None
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        if self._consumer is None:
+            self._consumer = loop.create_task(self._consume())
+        return await future
+
+    async def embed_many(self, texts: list[str]) -> list[list[float]]:
+        """
+        Encode a whole list as one batch, right away and regardless of max_batch_size. For callers that already have
+        their batch, like the batch endpoints. It still queues behind any batch being encoded, so the encoder only ever
+        runs one batch at a time.
+        :param texts:
+        :return: One vector per text, in order
+        """
+        loop = asyncio.get_running_loop()
+        batch = [(text, loop.create_future()) for text in texts]
+        await self._run(batch)
+        return [future.result() for _, future in batch]
+
+    async def _consume(self):
+        try:
+            # The first text found the encoder idle. Give others max_wait to join it, unless a full batch shows up.
+            if len(self._pending) < self.max_batch_size and self.max_wait:
+                try:
+                    async with asyncio.timeout(self.max_wait):
+                        await self._full.wait()
+                except TimeoutError:
+                    pass
+            # From here on the encoder never waits: whenever it's free it gets everything that piled up meanwhile.
+            while self._pending:
+                batch = self._pending[: self.max_batch_size]
+                self._pending = self._pending[self.max_batch_size :]
+                self._full.clear()
+                await self._run(batch)
+        finally:
+            self._consumer = None
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]):
+        if self._encode_lock is None:
+            self._encode_lock = asyncio.Lock()
+        # Callers that gave up (cancelled request) don't need encoding.
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        # Identical texts in the same batch only get encoded once.
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+        ENCODE_BATCH_SIZE.observe(len(unique_texts))
+        async with self._encode_lock:
+            try:
+                with timed(ENCODE_SECONDS):
+                    vectors = await asyncio.to_thread(self.encode_batch, unique_texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        self.logger.debug(f"Encoded a batch of {len(unique_texts)} queries")
+        by_text = dict(zip(unique_texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
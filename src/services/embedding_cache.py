@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+
+from core.metrics import CACHE_LOOKUPS
+
+
+def normalize_query(text: str) -> str:
+    """
+    Collapse whitespace and case so "Who is  Cthulhu?" and "who is cthulhu?" share an entry. The default bge model is
+    uncased, so case never changes its embedding anyway.
+    """
+    return " ".join(text.split()).lower()
+
+
+class EmbeddingCache:
+    """
+    A bounded in-process cache of query embeddings with LRU eviction and an optional TTL.
+
+    Keys are the normalized query text plus the embedding model name, so switching EMBEDDING_MODEL can never serve a
+    vector from the wrong model. If a path is given, entries are also written through to a small SQLite file so the
+    cache survives restarts. The in-memory LRU is always checked first and the disk store only on a memory miss.
+    Writes to the file happen behind the scenes in a worker thread, batched into one commit, so a put never blocks
+    the event loop on disk I/O.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = 4096,
+        ttl_seconds: float = 0,
+        path: str | None = None,
+    ):
+        """
+        :param model_name: The embedding model the vectors come from. Part of every key.
+        :param max_entries: Maximum entries held in memory. 0 turns the cache off.
+        :param ttl_seconds: How long an entry stays valid. 0 means forever (until evicted).
+        :param path: Optional SQLite file to persist entries in.
+        """
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        # The worker thread writing to the file and the event loop reading from it share one connection.
+        self._db_lock = threading.Lock()
+        self._writes: dict[str, tuple[float, list[float]]] = {}
+        self._writer: asyncio.Task | None = None
+        if path and self.enabled:
+            self._open_db(path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}\x00{normalize_query(text)}"
+
+    def _expired(self, created: float) -> bool:
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def get(self, text: str) -> list[float] | None:
+        if not self.enabled:
+            return None
+        key = self._key(text)
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            entry = self._db_get(key)
+            if entry is not None:
+                self._store(key, entry)
+        if entry is None or self._expired(entry[0]):
+            if entry is not None:
+                self._entries.pop(key, None)
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="embedding", result="miss")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache="embedding", result="hit")
+        return entry[1]
+
+    def put(self, text: str, vector: list[float]):
+        if not self.enabled:
+            return
+        key = self._key(text)
+        entry = (time.time(), vector)
+        self._store(key, entry)
+        if self._db is not None:
+            self._queue_write(key, entry)
+
+    def _queue_write(self, key: str, entry: tuple[float, list[float]]):
+        # Writes pile up while the writer is busy and all go out in its next commit, a later put of the same key
+        # simply replaces the queued one.
+        self._writes[key] = entry
+        if self._writer is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (a script using the cache directly), nothing to block so just write it.
+            self._db_put(self._take_writes())
+            return
+        self._writer = loop.create_task(self._write_behind())
+
+    def _take_writes(self) -> dict[str, tuple[float, list[float]]]:
+        writes, self._writes = self._writes, {}
+        return writes
+
+    async def _write_behind(self):
+        try:
+            while self._writes:
+                await asyncio.to_thread(self._db_put, self._take_writes())
+        except Exception:
+            # Losing a few cache entries isn't worth failing anything over, they'll just be encoded again.
+            self.logger.exception("Failed to write embeddings to the on-disk cache")
+        finally:
+            self._writer = None
+
+    def _store(self, key: str, entry: tuple[float, list[float]]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _open_db(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # We only touch the connection from the event loop thread, but check_same_thread would still trip if the
+        # app happens to be torn down from another thread.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # This is a cache, losing the last few writes on a crash is fine and we don't want an fsync per query.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, created REAL, vector BLOB)"
+        )
+        if self.ttl:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,)
+            )
+        self._db.commit()
+        self.logger.info(f"Using on-disk embedding cache at {path}")
+
+    def _db_get(self, key: str) -> tuple[float, list[float]] | None:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT created, vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        vector = array("f")
+        vector.frombytes(row[1])
+        return row[0], vector.tolist()
+
+    def _db_put(self, writes: dict[str, tuple[float, list[float]]]):
+        rows = [
+            (key, created, array("f", vector).tobytes())
+            for key, (created, vector) in writes.items()
+        ]
+        with self._db_lock:
+            # The cache may have been closed while this was waiting for a thread.
+            if self._db is None or not rows:
+                return
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, created, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            # Whatever the writer hasn't picked up yet still goes to disk, a write already in flight finishes first
+            # since it holds the lock.
+            self._db_put(self._take_writes())
+            with self._db_lock:
+                self._db.close()
+                self._db = None
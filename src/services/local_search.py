@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from core.config import Config
+from core.metrics import SEARCH_SECONDS, timed
+from models.chat import ChatMessage
+from models.search import SearchHit
+from services.search_service import VectorSearch, latest_user_message
+
+EMBEDDINGS_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.jsonl"
+OFFSETS_FILE = "offsets.npy"
+MANIFEST_FILE = "manifest.json"
+# scripts/prep_docs.py with CORPUS_FORMAT=npy puts the embeddings next to the corpus in this file (see
+# scripts/corpus_io.py) and leaves them out of the jsonl records.
+CORPUS_EMBEDDINGS_SUFFIX = ".embeddings.npy"
+
+logger = logging.getLogger(__name__)
+
+
+def _corpus_embeddings(corpus_path: Path) -> Path:
+    return corpus_path.with_name(corpus_path.name + CORPUS_EMBEDDINGS_SUFFIX)
+
+
+def _corpus_signature(corpus_path: Path) -> dict:
+    stat = corpus_path.stat()
+    signature = {
+        "corpus": str(corpus_path.resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+    embeddings = _corpus_embeddings(corpus_path)
+    if embeddings.exists():
+        signature["embeddings_mtime"] = embeddings.stat().st_mtime
+    return signature
+
+
+def index_is_current(corpus_path: Path, index_dir: Path) -> bool:
+    manifest_path = index_dir / MANIFEST_FILE
+    if not manifest_path.exists():
+        return False
+    manifest = json.loads(manifest_path.read_text())
+    return manifest.get("source") == _corpus_signature(corpus_path)
+
+
+def build_local_index(corpus_path: Path, index_dir: Path) -> int:
+    """
+    Turn the chunks jsonl written by scripts/prep_docs.py into the on-disk layout LocalVectorSearch memory-maps:
+
+    * embeddings.npy - an (n_chunks, dims) float32 matrix
+    * metadata.jsonl - one line per chunk with everything except the embedding
+    * offsets.npy - byte offset of each metadata line so we can pull out just the top-k rows
+
+    The corpus is streamed twice (once to size the matrix, once to fill it) so memory stays flat no matter how big the
+    jsonl gets. An npy corpus (CORPUS_FORMAT=npy) is sized from its embeddings matrix instead and the rows are copied
+    straight across.
+    :param corpus_path: The CORPUS_JSONL_FILE
+    :param index_dir: Where to write the index files
+    :return: The number of chunks indexed
+    """
+    index_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    corpus_embeddings = _corpus_embeddings(corpus_path)
+    source = None
+    if corpus_embeddings.exists():
+        # An npy corpus already has its embeddings as a matrix, we only need them as normalized float32.
+        source = np.load(corpus_embeddings, mmap_mode="r")
+        count, dims = source.shape
+    else:
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            first = f.readline()
+            if not first:
+                raise ValueError(f"Corpus file {corpus_path} is empty")
+            dims = len(json.loads(first)["embedding"])
+            count = 1 + sum(1 for line in f if line.strip())
+
+    matrix = np.lib.format.open_memmap(
+        index_dir / EMBEDDINGS_FILE, mode="w+", dtype=np.float32, shape=(count, dims)
+    )
+    offsets = np.zeros(count, dtype=np.int64)
+    with (
+        open(corpus_path, "r", encoding="utf-8") as f,
+        open(index_dir / METADATA_FILE, "wb") as meta_f,
+    ):
+        row = 0
+        for line in f:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if source is None:
+                matrix[row] = doc.pop("embedding")
+            offsets[row] = meta_f.tell()
+            meta_f.write(json.dumps(doc).encode("utf-8") + b"\n")
+            row += 1
+    if source is not None:
+        if row != count:
+            raise ValueError(
+                f"{corpus_embeddings} has {count} rows but {corpus_path} has {row} records"
+            )
+        # Copy in blocks so a float16 corpus is converted without materializing it all at once.
+        for block in range(0, count, 65536):
+            matrix[block : block + 65536] = source[block : block + 65536]
+        del source
+    # The chunks should already be normalized by prep_docs, but it's cheap to make sure the dot product really is
+    # cosine similarity.
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    matrix.flush()
+    del matrix
+    np.save(index_dir / OFFSETS_FILE, offsets)
+    (index_dir / MANIFEST_FILE).write_text(
+        json.dumps(
+            {
+                "source": _corpus_signature(corpus_path),
+                "count": count,
+                "dims": dims,
+            }
+        )
+    )
+    logger.info(
+        f"Built local index of {count} chunks in {index_dir} in {time.perf_counter() - start:.1f}s"
+    )
+    return count
+
+
+class LocalVectorSearch(VectorSearch):
+    """
+    Retrieval straight out of a memory-mapped NumPy matrix, for corpora small enough that an ES round trip is most of
+    the search latency. The Lovecraft set is a few thousand chunks, so scoring every one of them is a single
+    matrix-vector product that takes well under a millisecond, and np.argpartition pulls out the top k without sorting
+    everything.
+
+    The index is built from CORPUS_JSONL_FILE into LOCAL_INDEX_DIR on startup if it's missing or older than the corpus.
+    You can also build it ahead of time with `make build-local-index`.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.index_dir = Path(config.local_index_dir)
+        corpus_path = Path(config.corpus_jsonl_file or "")
+        if corpus_path.is_file() and not index_is_current(corpus_path, self.index_dir):
+            self.logger.info(f"Building local vector index from {corpus_path}")
+            build_local_index(corpus_path, self.index_dir)
+        if not (self.index_dir / MANIFEST_FILE).exists():
+            raise FileNotFoundError(
+                f"No local vector index in {self.index_dir} and no corpus at '{corpus_path}' to build one from"
+            )
+        self.matrix = np.load(self.index_dir / EMBEDDINGS_FILE, mmap_mode="r")
+        self.offsets = np.load(self.index_dir / OFFSETS_FILE)
+        self._meta_file = open(self.index_dir / METADATA_FILE, "rb")
+        self.metadata = mmap.mmap(self._meta_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.logger.info(
+            f"Loaded local vector index with {self.matrix.shape[0]} chunks from {self.index_dir}"
+        )
+
+    def _metadata_row(self, row: int) -> dict:
+        start = int(self.offsets[row])
+        end = self.metadata.find(b"\n", start)
+        return json.loads(self.metadata[start:end])
+
+    def top_k(self, embedding: list[float], k: int) -> list[tuple[int, float]]:
+        return self._top_rows(self.matrix @ np.asarray(embedding, dtype=np.float32), k)
+
+    @staticmethod
+    def _top_rows(scores: np.ndarray, k: int) -> list[tuple[int, float]]:
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    async def warm_up(self):
+        """
+        Besides the encoder, read the whole matrix once so the first searches don't stall on page faults.
+        """
+        await super().warm_up()
+        await asyncio.to_thread(lambda: float(np.sum(self.matrix, dtype=np.float64)))
+
+    async def search(
+        self,
+        messages: list[ChatMessage],
+        top_k,
+        query_vector: list[float] | None = None,
+    ) -> list[SearchHit]:
+        """
+        Same contract as ESSearch.search, answered from the local matrix instead of Elasticsearch.
+        """
+        latest_user_msg = latest_user_message(messages)
+        if not latest_user_msg:
+            return []
+        embedding = query_vector or await self.embed_query(latest_user_msg)
+        with timed(SEARCH_SECONDS, "search", backend="local", mode="exact"):
+            result = [
+                SearchHit(score=score, **self._metadata_row(row))
+                for row, score in self.top_k(embedding, top_k or self.top_k_results)
+            ]
+        self.logger.debug([(h.story_title, h.chunk_id, h.score) for h in result])
+        return result
+
+    async def search_many(
+        self, queries: list[str], top_k, query_vectors: list[list[float]]
+    ) -> list[list[SearchHit] | Exception]:
+        """
+        The whole batch is scored with one matrix-matrix product, which is a lot cheaper than a product per query.
+        """
+        if not queries:
+            return []
+        k = top_k or self.top_k_results
+        with timed(SEARCH_SECONDS, "search", backend="local", mode="exact_batch"):
+            # (chunks, queries), one column of scores per query
+            scores = self.matrix @ np.asarray(query_vectors, dtype=np.float32).T
+            return [
+                [
+                    SearchHit(score=score, **self._metadata_row(row))
+                    for row, score in self._top_rows(column, k)
+                ]
+                for column in scores.T
+            ]
+
+    def close(self):
+        super().close()
+        self.metadata.close()
+        self._meta_file.close()
+
+
+if __name__ == "__main__":
+    # PYTHONPATH=./src python -m services.local_search
+    config = Config()
+    if not config.corpus_jsonl_file or not os.path.exists(config.corpus_jsonl_file):
+        print(f"CORPUS_JSONL_FILE not found: {config.corpus_jsonl_file}")
+        sys.exit(1)
+    build_local_index(Path(config.corpus_jsonl_file), Path(config.local_index_dir))
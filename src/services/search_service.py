@@ -1,16 +1,86 @@
 from models.chat import ChatMessage
+from models.search import SearchHit
 from core.config import Config
+from core.metrics import (
+    EMBED_SECONDS,
+    ES_TOOK_SECONDS,
+    SEARCH_SECONDS,
+    record_timing,
+    timed,
+)
+from services.embedding_batcher import EmbeddingBatcher
+from services.embedding_cache import EmbeddingCache
+import asyncio
 import logging
+import time
+from abc import ABC, abstractmethod
 
+SEARCH_MODES = ("knn", "exact", "hybrid")
+
+
+def latest_user_message(messages: list[ChatMessage]) -> str:
+    return next((m.content for m in reversed(messages) if m.role == "user"), "")
+
+
+def es_transient(e: Exception) -> bool:
+    """
+    Whether an ES failure is the kind worth retrying and holding against the cluster: it couldn't be reached, timed
+    out, or said it's overloaded or broken. A malformed query isn't.
+    """
+    from elastic_transport import ConnectionError, ConnectionTimeout
+    from elasticsearch import ApiError
+
+    if isinstance(e, (ConnectionError, ConnectionTimeout)):
+        return True
+    return isinstance(e, ApiError) and (e.meta.status >= 500 or e.meta.status == 429)
+
+
+def reciprocal_rank_fusion(
+    result_lists: list[list[dict]], weights: list[float], rank_constant: int = 60
+) -> list[tuple[dict, float]]:
+    """
+    Fuse several ranked lists of ES hits into one. Every hit earns weight / (rank_constant + rank) from each list it
+    appears in, so documents that rank well in both BM25 and kNN float to the top without having to make the two score
+    scales comparable.
+    :param result_lists: ES hit lists, best first
+    :param weights: One weight per list
+    :param rank_constant: Damps the advantage of the very top ranks. 60 is the value from the original RRF paper.
+    :return: (hit, fused score) pairs, best first
+    """
+    fused: dict[str, list] = {}
+    for hits, weight in zip(result_lists, weights):
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.setdefault(hit["_id"], [hit, 0.0])
+            entry[1] += weight / (rank_constant + rank)
+    return sorted(
+        ((hit, score) for hit, score in fused.values()),
+        key=lambda pair: pair[1],
+        reverse=True,
+    )
+
+
+class VectorSearch(ABC):
+    """
+    The parts every retrieval backend shares: turning the user's question into a query vector with the same model
+    the corpus was embedded with. Backends implement search() on top of embed_query().
+    """
 
-class ESSearch:
     def __init__(self, config: Config):
-        self.es_client = config.es_client
-        self.index: str = config.es_index
         self.embedding_model: str = config.embedding_model
-        self.top_k_results: str = config.top_k_search_results
+        self.top_k_results: int = config.top_k_search_results
         self.logger = logging.getLogger(self.__class__.__name__)
         self._encoder = None
+        self.batcher = EmbeddingBatcher(
+            self._encode_batch,
+            max_batch_size=config.embed_batch_max_size,
+            max_wait_ms=config.embed_batch_max_wait_ms,
+        )
+        self.cache = EmbeddingCache(
+            self.embedding_model,
+            max_entries=config.embed_cache_size,
+            ttl_seconds=config.embed_cache_ttl_seconds,
+            path=config.embed_cache_path,
+        )
 
     @property
     def encoder(self):
@@ -20,29 +90,159 @@ class ESSearch:
             self._encoder = SentenceTransformer(self.embedding_model)
         return self._encoder
 
-    def embed_query(self, query: str) -> list[int]:
-        return self.encoder.encode(query, normalize_embeddings=True).tolist()
+    def _encode_batch(self, queries: list[str]) -> list[list[float]]:
+        return self.encoder.encode(
+            queries, batch_size=len(queries), normalize_embeddings=True
+        ).tolist()
 
-    def search(self, messages: list[ChatMessage], top_k) -> list[str]:
+    async def warm_up(self):
         """
-        This version of search is just doing simple vector similarity. It's not great for negation or any
-        sort of deeper linguistic preprocessing that could enhance results, but it is a simple for a personal project
-        and sufficient for now.
-        :param messages: The list of messages coming in for lookup. Better not be very many if the LLM context window is small!
-        :param top_k: The number of best results to return. Keep this value small for a small window! The number of results
-        before things break is related to the sum of the size of the context window, length of the rest of the system prompt, length of the
-        chunks of text as you preprocessed with the prep_docs script, and whether you are feeding context back in for future turns (we aren't for now)
-        :return: The list of document strings
+        Load the encoder and push one query through it, so the first real request doesn't pay for loading (or even
+        downloading) the model. Straight to the encoder rather than through the cache, which would remember the dummy.
+        """
+        await asyncio.to_thread(self._encode_batch, ["warm up"])
+
+    async def embed_query(self, query: str) -> list[float]:
+        # Encoding is CPU bound, so the batcher runs it in a worker thread rather than blocking the event loop, and
+        # concurrent queries share a single encode call. Popular questions come straight out of the cache.
+        with timed(EMBED_SECONDS, "embed"):
+            cached = self.cache.get(query)
+            if cached is not None:
+                return cached
+            embedding = await self.batcher.embed(query)
+            self.cache.put(query, embedding)
+            return embedding
+
+    async def embed_queries(self, queries: list[str]) -> list[list[float]]:
         """
-        latest_user_msg = next(
-            (m.content for m in reversed(messages) if m.role == "user"), ""
+        Embed a batch of queries at once. Whatever isn't cached goes through the encoder as a single batch.
+        :param queries:
+        :return: One vector per query, in order
+        """
+        start = time.perf_counter()
+        vectors = [self.cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(q for q, v in zip(queries, vectors) if v is None))
+        if missing:
+            encoded = dict(zip(missing, await self.batcher.embed_many(missing)))
+            for query, vector in encoded.items():
+                self.cache.put(query, vector)
+            vectors = [
+                v if v is not None else encoded[q] for q, v in zip(queries, vectors)
+            ]
+        record_timing("embed", time.perf_counter() - start)
+        return vectors
+
+    def close(self):
+        self.cache.close()
+
+    @abstractmethod
+    async def search(
+        self,
+        messages: list[ChatMessage],
+        top_k,
+        query_vector: list[float] | None = None,
+    ) -> list[SearchHit]:
+        """
+        Retrieve the chunks for the latest user message.
+        :param messages: The conversation so far
+        :param top_k: Hits to return, falling back to TOP_K_ES_RESULTS
+        :param query_vector: The embedding of the latest user message if the caller already has it
+        :return: The hits with their scores, best first
+        """
+
+    async def search_many(
+        self, queries: list[str], top_k, query_vectors: list[list[float]]
+    ) -> list[list[SearchHit] | Exception]:
+        """
+        Search for a batch of queries. Backends override this to do it in one go, this fallback just runs the searches
+        concurrently.
+        :param queries: The questions
+        :param top_k: Hits per query, falling back to TOP_K_ES_RESULTS
+        :param query_vectors: Their embeddings, see embed_queries
+        :return: The hits for each query in order, or the exception its search failed with
+        """
+        return await asyncio.gather(
+            *(
+                self.search(
+                    [ChatMessage(role="user", content=query)],
+                    top_k,
+                    query_vector=vector,
+                )
+                for query, vector in zip(queries, query_vectors)
+            ),
+            return_exceptions=True,
         )
-        if not latest_user_msg:
-            return []
-        embedding = self.embed_query(latest_user_msg)
+
+
+class ESSearch(VectorSearch):
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.config = config
+        self.index: str = config.es_index
+        self.mode: str = config.es_search_mode
+        self.knn_k: int = config.es_knn_k
+        self.knn_num_candidates: int = config.es_knn_num_candidates
+        self.hybrid_candidates: int = config.es_hybrid_candidates
+        self.hybrid_weights: list[float] = [
+            config.es_hybrid_bm25_weight,
+            config.es_hybrid_knn_weight,
+        ]
+        self.hybrid_rank_constant: int = config.es_hybrid_rank_constant
+        if self.mode not in SEARCH_MODES:
+            raise ValueError(
+                f"Unknown ES_SEARCH_MODE '{self.mode}', expected one of {SEARCH_MODES}"
+            )
+
+    @property
+    def es_client(self):
+        return self.config.es_client
+
+    async def _call_es(self, method: str, **kwargs):
+        # Every search goes through the retry policy and circuit breaker shared with the rest of the app.
+        return await self.config.es_retry.run(
+            lambda: getattr(self.es_client, method)(**kwargs),
+            es_transient,
+            self.config.es_breaker,
+        )
+
+    async def warm_up(self):
+        """
+        Besides the encoder, create the ES client (that's where the library gets imported, so off the event loop) and
+        check that the cluster answers and our index or alias is there. The ping also leaves a connection in the pool.
+        """
+        await super().warm_up()
+        es_client = await asyncio.to_thread(lambda: self.config.es_client)
+        if not await es_client.ping():
+            raise ConnectionError(
+                f"Failed to connect to Elasticsearch at {self.config.es_host}"
+            )
+        if not await es_client.indices.exists(index=self.index):
+            raise LookupError(
+                f"Elasticsearch index or alias '{self.index}' does not exist"
+            )
+
+    def build_query(
+        self, embedding: list[float], size: int, mode: str | None = None
+    ) -> dict:
+        """
+        Build the ES request body for a query vector.
+
+        In "knn" mode we let ES walk the HNSW graph that the index mapping already builds for the embedding field, so
+        query cost stays roughly flat as the corpus grows. The "exact" mode is the original brute-force
+        script_score over every chunk, kept around so we can check how much recall the approximate search gives up.
+        :param embedding: The normalized query vector
+        :param size: How many hits to return
+        :param mode: Override for the configured search mode
+        :return: The request body
+        """
+        mode = mode or self.mode
         body = {
-            "size": self.top_k_results,
-            "query": {
+            "size": size,
+            # We never use the stored vectors after the search, so don't ship them back over the wire.
+            "_source": {"excludes": ["embedding"]},
+        }
+        if mode == "exact":
+            body["query"] = {
                 "script_score": {
                     "query": {"match_all": {}},
                     "script": {
@@ -50,12 +250,144 @@ class ESSearch:
                         "params": {"query_vector": embedding},
                     },
                 }
-            },
+            }
+        else:
+            k = max(self.knn_k, size)
+            body["knn"] = {
+                "field": "embedding",
+                "query_vector": embedding,
+                "k": k,
+                "num_candidates": max(self.knn_num_candidates, k),
+            }
+        return body
+
+    def _record_took(self, took_ms: int, mode: str | None = None):
+        # ES's own view of the search time. Whatever the round trip adds on top is network, queueing and the client.
+        ES_TOOK_SECONDS.observe(took_ms / 1000, mode=mode or self.mode)
+        record_timing("es", took_ms / 1000)
+
+    async def _hybrid_hits(
+        self, query: str, embedding: list[float], size: int
+    ) -> list[tuple[dict, float]]:
+        """
+        BM25 catches the names and exact phrases ("Nyarlathotep", "the colour out of space") that pure vector
+        similarity tends to blur, and kNN catches the paraphrases BM25 misses. Both searches go out in a single _msearch
+        so hybrid costs one round trip, and the rankings are fused client side with weighted RRF.
+        :param query: The user's question
+        :param embedding: Its query vector
+        :param size: How many fused hits to return
+        :return: (hit, fused score) pairs, best first
+        """
+        response = await self._call_es(
+            "msearch",
+            index=self.index,
+            searches=self._hybrid_searches(query, embedding, size),
+        )
+        self._record_took(response["took"])
+        return self._fuse(response["responses"], size)
+
+    def _hybrid_searches(
+        self, query: str, embedding: list[float], size: int
+    ) -> list[dict]:
+        # _msearch header and body lines for the BM25 and kNN halves of a hybrid search
+        window = max(self.hybrid_candidates, size)
+        bm25_body = {
+            "size": window,
+            "_source": {"excludes": ["embedding"]},
+            "query": {"match": {"text": query}},
         }
-        search_result = self.es_client.search(index=self.index, body=body)
+        return [{}, bm25_body, {}, self.build_query(embedding, window, mode="knn")]
+
+    def _fuse(self, responses: list[dict], size: int) -> list[tuple[dict, float]]:
+        result_lists = []
+        for name, item in zip(("bm25", "knn"), responses):
+            if "error" in item:
+                raise RuntimeError(f"Hybrid {name} search failed: {item['error']}")
+            result_lists.append(item["hits"]["hits"])
+        fused = reciprocal_rank_fusion(
+            result_lists, self.hybrid_weights, self.hybrid_rank_constant
+        )
+        return fused[:size]
+
+    @staticmethod
+    def _to_hits(scored: list[tuple[dict, float]]) -> list[SearchHit]:
         result = []
-        for hit in search_result["hits"]["hits"]:
-            del hit["_source"]["embedding"]
-            result.append(str(hit["_source"]))
-        self.logger.debug(result)
+        for hit, score in scored:
+            hit["_source"].pop("embedding", None)
+            result.append(SearchHit(score=score, **hit["_source"]))
+        return result
+
+    async def search(
+        self,
+        messages: list[ChatMessage],
+        top_k,
+        query_vector: list[float] | None = None,
+    ) -> list[SearchHit]:
+        """
+        This version of search is just doing simple vector similarity, approximate kNN by default. It's not great for negation or any
+        sort of deeper linguistic preprocessing that could enhance results, but it is a simple for a personal project
+        and sufficient for now. The "hybrid" mode adds BM25 on the chunk text to help with names and exact phrases.
+        :param messages: The list of messages coming in for lookup. Better not be very many if the LLM context window is small!
+        :param top_k: The number of best results to return, falling back to TOP_K_ES_RESULTS. The context assembler trims
+        whatever comes back to the prompt token budget, so this only decides how many candidates it gets to choose from.
+        :param query_vector: The embedding of the latest user message if the caller already has it.
+        :return: The hits with their scores, best first
+        """
+        latest_user_msg = latest_user_message(messages)
+        if not latest_user_msg:
+            return []
+        embedding = query_vector or await self.embed_query(latest_user_msg)
+        size = top_k or self.top_k_results
+        with timed(SEARCH_SECONDS, "search", backend="elasticsearch", mode=self.mode):
+            if self.mode == "hybrid":
+                scored = await self._hybrid_hits(latest_user_msg, embedding, size)
+            else:
+                body = self.build_query(embedding, size)
+                search_result = await self._call_es(
+                    "search", index=self.index, body=body
+                )
+                self._record_took(search_result["took"])
+                scored = [(hit, hit["_score"]) for hit in search_result["hits"]["hits"]]
+        result = self._to_hits(scored)
+        self.logger.debug([(h.story_title, h.chunk_id, h.score) for h in result])
         return result
+
+    async def search_many(
+        self, queries: list[str], top_k, query_vectors: list[list[float]]
+    ) -> list[list[SearchHit] | Exception]:
+        """
+        All the searches of a batch go out in a single _msearch, so a batch costs one round trip whatever its size. A
+        search that fails only fails its own query.
+        """
+        if not queries:
+            # ES rejects an _msearch without any searches in it.
+            return []
+        size = top_k or self.top_k_results
+        searches = []
+        for query, embedding in zip(queries, query_vectors):
+            if self.mode == "hybrid":
+                searches.extend(self._hybrid_searches(query, embedding, size))
+            else:
+                searches.extend([{}, self.build_query(embedding, size)])
+        mode = f"{self.mode}_batch"
+        with timed(SEARCH_SECONDS, "search", backend="elasticsearch", mode=mode):
+            response = await self._call_es(
+                "msearch", index=self.index, searches=searches
+            )
+        self._record_took(response["took"], mode=mode)
+
+        per_query = 2 if self.mode == "hybrid" else 1
+        results = []
+        for i in range(len(queries)):
+            items = response["responses"][i * per_query : (i + 1) * per_query]
+            try:
+                if self.mode == "hybrid":
+                    scored = self._fuse(items, size)
+                elif "error" in items[0]:
+                    raise RuntimeError(f"Search failed: {items[0]['error']}")
+                else:
+                    scored = [(hit, hit["_score"]) for hit in items[0]["hits"]["hits"]]
+                results.append(self._to_hits(scored))
+            except Exception as e:
+                results.append(e)
+        return results
@@ -0,0 +1,182 @@
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from core.metrics import CACHE_LOOKUPS
+from models.search import SearchHit
+
+REUSE = "reuse"
+EXTEND = "extend"
+SEARCH = "search"
+
+
+class ConversationSession:
+    """
+    What we remember about one conversation: the hits retrieved so far and, for each of them, the embedding of the
+    question it was retrieved for and the score the search gave it. The chunk embeddings themselves stay in ES (we deliberately don't ship them back with
+    the hits), and the question that found a chunk is a good enough stand-in when deciding if it still applies.
+    """
+
+    __slots__ = ("anchor", "hits", "hit_vectors", "hit_scores", "last_used")
+
+    def __init__(self):
+        # Embedding of the last question we actually searched for
+        self.anchor: np.ndarray | None = None
+        self.hits: list[SearchHit] = []
+        self.hit_vectors: list[np.ndarray] = []
+        # The hits' scores get down-weighted as the conversation moves on, these are the ones they were found with.
+        self.hit_scores: list[float] = []
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """
+    Retrieved context per conversation, so follow-up turns don't have to search again.
+
+    Most follow-ups ("and what happened to him after that?") are about the same thing as the question before them, and
+    searching again mostly returns the same chunks. Each turn's question embedding is compared with the last question
+    we searched for in that conversation:
+
+    * at or above reuse_threshold the cached hits are reused as they are and no search runs,
+    * at or above extend_threshold we search, and the new hits are merged into the cached ones, so the context grows
+      with the conversation instead of starting over. Older hits are down-weighted by how far the question has moved,
+    * below that the conversation has drifted to something else and the fresh hits replace the cached ones.
+
+    Sessions are kept in LRU order, at most max_sessions of them, and dropped once idle for longer than the TTL.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1024,
+        idle_ttl_seconds: float = 1800,
+        reuse_threshold: float = 0.9,
+        extend_threshold: float = 0.75,
+        max_hits: int = 20,
+    ):
+        """
+        :param max_sessions: How many conversations to keep. 0 turns the store off.
+        :param idle_ttl_seconds: Drop a conversation after this long without a turn. 0 means only LRU eviction.
+        :param reuse_threshold: Minimum cosine similarity with the last searched question to skip the search.
+        :param extend_threshold: Minimum cosine similarity to merge new hits into the cached ones rather than replace them.
+        :param max_hits: Cap on the hits kept per conversation, best first.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = idle_ttl_seconds
+        self.reuse_threshold = reuse_threshold
+        self.extend_threshold = extend_threshold
+        self.max_hits = max_hits
+        self.logger = logging.getLogger(self.__class__.__name__)
+        # conversation id -> session, in least to most recently used order
+        self._sessions: OrderedDict[str, ConversationSession] = OrderedDict()
+        self.decisions = {REUSE: 0, EXTEND: 0, SEARCH: 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_sessions > 0
+
+    def _get(self, conversation_id: str) -> ConversationSession | None:
+        session = self._sessions.get(conversation_id)
+        if session is None:
+            return None
+        if self.ttl and time.time() - session.last_used > self.ttl:
+            del self._sessions[conversation_id]
+            return None
+        self._sessions.move_to_end(conversation_id)
+        return session
+
+    def _evict_idle(self):
+        # Sessions are in last used order, so the idle ones are all at the front.
+        now = time.time()
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if not self.ttl or now - oldest.last_used <= self.ttl:
+                break
+            del self._sessions[oldest_id]
+
+    def plan(
+        self, conversation_id: str, vector: list[float]
+    ) -> tuple[str, list[SearchHit]]:
+        """
+        Decide what retrieval a turn needs.
+        :param conversation_id:
+        :param vector: Embedding of the turn's question
+        :return: REUSE with the cached hits, or EXTEND / SEARCH with an empty list, meaning the caller should search and
+        hand the result to update()
+        """
+        session = self._get(conversation_id)
+        if session is None or session.anchor is None:
+            decision = SEARCH
+        else:
+            similarity = float(session.anchor @ np.asarray(vector, dtype=np.float32))
+            if similarity >= self.reuse_threshold:
+                decision = REUSE
+            elif similarity >= self.extend_threshold:
+                decision = EXTEND
+            else:
+                decision = SEARCH
+            self.logger.debug(
+                f"Conversation {conversation_id}: similarity {similarity:.3f} to the last search, {decision}"
+            )
+        self.decisions[decision] += 1
+        CACHE_LOOKUPS.inc(cache="session", result=decision)
+        if decision == REUSE:
+            session.last_used = time.time()
+            return decision, list(session.hits)
+        return decision, []
+
+    def update(
+        self,
+        conversation_id: str,
+        decision: str,
+        vector: list[float],
+        hits: list[SearchHit],
+    ) -> list[SearchHit]:
+        """
+        Record the hits of a turn that searched.
+        :param conversation_id:
+        :param decision: What plan() said, EXTEND merges into the cached hits and SEARCH replaces them
+        :param vector: Embedding of the turn's question
+        :param hits: What the search returned
+        :return: The hits to build the context from, which for EXTEND includes the cached ones
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        session = self._get(conversation_id)
+        if session is None:
+            self._evict_idle()
+            if len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            session = self._sessions[conversation_id] = ConversationSession()
+
+        scored = [(hit, vector, hit.score) for hit in hits]
+        if decision == EXTEND:
+            seen = {(hit.source, hit.story_title, hit.chunk_id) for hit in hits}
+            for hit, hit_vector, original in zip(
+                session.hits, session.hit_vectors, session.hit_scores
+            ):
+                if (hit.source, hit.story_title, hit.chunk_id) in seen:
+                    continue
+                # A chunk found for an earlier question counts for as much as that question resembles this one. Always
+                # weighted from the score it was found with, so a hit carried over several turns isn't down-weighted
+                # again on each of them.
+                similarity = max(float(hit_vector @ vector), 0.0)
+                scored.append(
+                    (
+                        hit.model_copy(update={"score": original * similarity}),
+                        hit_vector,
+                        original,
+                    )
+                )
+            scored.sort(key=lambda entry: entry[0].score, reverse=True)
+        scored = scored[: self.max_hits]
+
+        session.anchor = vector
+        session.hits = [hit for hit, _, _ in scored]
+        session.hit_vectors = [hit_vector for _, hit_vector, _ in scored]
+        session.hit_scores = [original for _, _, original in scored]
+        session.last_used = time.time()
+        return list(session.hits)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), **self.decisions}